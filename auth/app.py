@@ -1,19 +1,19 @@
-from flask import Flask, request, jsonify
+from flask import Flask, request, jsonify, abort, make_response
 from flask_jwt_extended import JWTManager, create_access_token, jwt_required, get_jwt_identity
 from flask_sqlalchemy import SQLAlchemy
-from models import db, User
+from models import db, User, RoundSettlement
+from db_router import router, master_position, CONSISTENCY_HEADER
+from password_hashing import hasher, HashingBusy
+from balance_cache import BalanceCache
+import ledger
 from config import Config
 import argparse
 import time
 import requests
 from prometheus_flask_exporter import PrometheusMetrics
 import redis
-from random import choice
-from sqlalchemy import create_engine
-from sqlalchemy.exc import OperationalError
+from sqlalchemy.exc import IntegrityError, SQLAlchemyError
 import logging
-from sqlalchemy.orm import sessionmaker, scoped_session
-from sqlalchemy import text
 
 app = Flask(__name__)
 app.logger.setLevel(logging.DEBUG)
@@ -23,77 +23,58 @@ db.init_app(app)
 # JWT Setup
 jwt = JWTManager(app)
 metrics = PrometheusMetrics(app)
-redis_client = redis.StrictRedis(host='redis', port=6379, db=0, decode_responses=True)
-
-# Global variables to store the master and replica engines
-master_engine = None
-replica_engines = []
-
-def initialize_engines():
-    global master_engine, replica_engines
-    
-    # Ensure we are within the Flask application context
-    with app.app_context():
+redis_client = redis.StrictRedis(host=app.config['REDIS_HOST'], port=app.config['REDIS_PORT'], db=0, decode_responses=True,
+                                 socket_timeout=app.config['REDIS_TIMEOUT'],
+                                 socket_connect_timeout=app.config['REDIS_TIMEOUT'])
+balance_cache = BalanceCache(redis_client, ttl=app.config['BALANCE_CACHE_TTL'])
+
+# Reads of GET requests are spread over the healthy replicas, see db_router.py
+router.init_app(app)
+hasher.init_app(app)
+
+# Requests that wrote return the master's binlog position. Clients send it back in the
+# X-Consistency-Token header so their next reads go to a replica that has the write
+@app.after_request
+def add_consistency_token(response):
+    if db.session.info.pop('wrote', False):
         try:
-            # Initialize master engine
-            master_engine = create_engine(app.config['SQLALCHEMY_DATABASE_URI'])
-            
-            # Close any previous session
-            db.session.remove()
-            
-            # Initialize replica engines
-            replica_engines = [
-                create_engine(app.config['SQLALCHEMY_BINDS'][key])
-                for key in app.config['SQLALCHEMY_BINDS'].keys() if key != 'master'
-            ]
-        except OperationalError as e:
-            app.logger.debug(f"Error connecting to databases: {e}")
-
-# Initialize the engines when the app starts
-initialize_engines()
-app.logger.debug(f"Master {master_engine}")
-app.logger.debug(f"Replicas {replica_engines}")
-
-def get_db_session():
-    if request.method == "GET" or 'SELECT' in request.method.upper():  # Read queries (GET or SELECT)
-        for replica_engine in replica_engines:
-            try:
-                # Using db.session for replica read operations
-                session = scoped_session(sessionmaker(bind=replica_engine))
-                session.execute(text("SELECT 1"))  # Test query to check replica
-                app.logger.debug(f"Session {replica_engine}")
-                return session
-            except OperationalError:
-                continue
-        # If all replicas are down, fallback to the master
-        app.logger.debug(f"All replicas are down")
-        session = scoped_session(sessionmaker(bind=master_engine))
-        return session
-    else:  # Write queries (POST, PUT, DELETE)
-        try:
-            session = scoped_session(sessionmaker(bind=master_engine))
-            session.execute(text("SELECT 1")) # Simple test query to check master
-            app.logger.debug(f"Session {master_engine}")
-            return session
-        except OperationalError:
-            app.logger.debug("Master is down, trying replicas for failover...")
-            # Failover to replicas in case master is down
-            for replica_engine in replica_engines:
-                try:
-                    session = scoped_session(sessionmaker(bind=replica_engine))
-                    session.execute(text("SELECT 1"))
-                    app.logger.debug(f"Session {replica_engine}")
-                    return session
-                except OperationalError:
-                    continue
-            # If all replicas fail, raise an exception
-            raise Exception("All databases (master and replicas) are unavailable.")
-
-@app.before_request
-def before_request():
-    db.session.remove()  # Remove any previous session
-    session = get_db_session()  # Get session with failover logic
-    db.session = session
+            token = master_position(db.engine)
+        except SQLAlchemyError as e:
+            app.logger.warning(f"Could not read the master position: {e}")
+            token = None
+        if token:
+            response.headers[CONSISTENCY_HEADER] = token
+    return response
+
+# Logins beyond what the hashing pool can take are turned away instead of queueing
+@app.errorhandler(HashingBusy)
+def hashing_busy(e):
+    return jsonify({"error": "Too many logins in progress, retry shortly"}), 503, {"Retry-After": "1"}
+
+def cached_user(user_id):
+    """ {'username', 'balance'} of the user, from the balance cache when possible. None if there is no such user. """
+    entry = balance_cache.get(user_id)
+    if entry is None:
+        user = db.session.get(User, user_id)
+        if user is None:
+            return None
+        entry = balance_cache.store(user)
+    return entry
+
+def commit_balances(*user_ids):
+    """ Commit ledger changes, invalidating the users' cached rows first and writing them through after. """
+    balance_cache.invalidate(*user_ids)
+    db.session.commit()
+    if user_ids:
+        for user in User.query.filter(User.id.in_(user_ids)):
+            balance_cache.store(user)
+
+def idempotency_key(user_id):
+    """ The request's Idempotency-Key header scoped to the user, None without one. """
+    key = request.headers.get('Idempotency-Key')
+    if key and len(key) > 100:
+        abort(make_response(jsonify({"error": "Idempotency-Key is too long"}), 400))
+    return f"{user_id}:{key}" if key else None
 
 # Register service with Service Discovery
 def register_service(service_type, service_id, retries=5, delay=5):
@@ -155,6 +136,8 @@ def login():
     user = User.query.filter_by(username=username).first()
 
     if user and user.check_password(password):
+        if user in db.session.dirty:
+            db.session.commit()  # the password was rehashed with the current rounds
         access_token = create_access_token(identity=user.id)
         return jsonify(access_token=access_token), 200
     else:
@@ -165,9 +148,9 @@ def login():
 @jwt_required()
 def get_balance():
     user_id = get_jwt_identity()
-    user = User.query.filter_by(id=user_id).first()
+    user = cached_user(user_id)
     if user:
-        return jsonify({"balance": user.balance}), 200
+        return jsonify({"balance": user['balance']}), 200
     return jsonify({"error": "User not found"}), 404
 
 # Update user balance (requires authentication)
@@ -181,14 +164,14 @@ def set_balance():
         return jsonify({"error": "Balance is required"}), 400
 
     user_id = get_jwt_identity()
-    user = User.query.get(user_id)
-    
-    if user:
-        user.balance = new_balance
-        db.session.commit()
-        return jsonify({"message": "Balance updated"}), 200
-
-    return jsonify({"error": "User not found"}), 404
+    try:
+        if not ledger.set_balance(user_id, new_balance, idempotency_key(user_id)):
+            db.session.rollback()
+            return jsonify({"error": "User not found"}), 404
+        commit_balances(user_id)
+    except IntegrityError:
+        db.session.rollback()  # a retry of a change that went through
+    return jsonify({"message": "Balance updated"}), 200
 
 # Update user balance (requires authentication)
 @app.route('/user/v1/balance', methods=['PUT'])
@@ -201,14 +184,14 @@ def update_balance():
         return jsonify({"error": "Ammount is required"}), 400
 
     user_id = get_jwt_identity()
-    user = User.query.filter_by(id=user_id).first()
-    
-    if user:
-        user.balance += ammount
-        db.session.commit()
-        return jsonify({"message": "Balance updated"}), 200
-
-    return jsonify({"error": "User not found"}), 404
+    try:
+        if not ledger.apply(user_id, ammount, 'update', idempotency_key(user_id)):
+            db.session.rollback()
+            return jsonify({"error": "User not found"}), 404
+        commit_balances(user_id)
+    except IntegrityError:
+        db.session.rollback()  # a retry of a change that went through
+    return jsonify({"message": "Balance updated"}), 200
 
 @app.route('/user/v1/balance/prepare', methods=['POST'])
 @jwt_required()
@@ -217,8 +200,8 @@ def prepare_balance():
     user_id = get_jwt_identity()
     amount = data['amount']
 
-    user = User.query.get(user_id)
-    if not user or user.balance + amount < 0:
+    user = cached_user(user_id)
+    if not user or user['balance'] + amount < 0:
         return jsonify({"error": "Insufficient funds or user not found"}), 400
 
     redis_client.set(f"prepare:{user_id}", amount)
@@ -230,15 +213,21 @@ def commit_balance():
     data = request.json
     user_id = get_jwt_identity()
 
-    prepared_amount = redis_client.get(f"prepare:{user_id}")
+    # Claimed atomically, so two concurrent commits cannot both apply it
+    prepared_amount = redis_client.getdel(f"prepare:{user_id}")
     if prepared_amount is None:
         return jsonify({"error": "No prepared transaction"}), 400
 
-    user = User.query.get(user_id)
-    user.balance += float(prepared_amount)
-    db.session.commit()
+    try:
+        if not ledger.apply(user_id, float(prepared_amount), 'commit'):
+            db.session.rollback()
+            return jsonify({"error": "User not found"}), 404
+        commit_balances(user_id)
+    except SQLAlchemyError:
+        db.session.rollback()
+        redis_client.set(f"prepare:{user_id}", prepared_amount)  # still prepared, the commit can be retried
+        raise
 
-    redis_client.delete(f"prepare:{user_id}")
     return jsonify({"status": "Committed"}), 200
 
 @app.route('/user/v1/balance/abort', methods=['POST'])
@@ -250,14 +239,68 @@ def abort_balance():
     redis_client.delete(f"prepare:{user_id}")
     return jsonify({"status": "Aborted"}), 200
 
+# Apply a whole game round's payouts in one transaction (service-to-service)
+@app.route('/user/v1/balance/batch', methods=['POST'])
+def batch_balance():
+    if request.headers.get('X-Service-Token') != app.config['SERVICE_TOKEN']:
+        return jsonify({"error": "Invalid service token"}), 401
+
+    entries = (request.json or {}).get('entries')
+    if not entries:
+        return jsonify({"error": "Entries are required"}), 400
+
+    try:
+        round_ids = {str(entry['round_id']) for entry in entries}
+        settled = {
+            round_id for (round_id,) in
+            db.session.query(RoundSettlement.round_id).filter(RoundSettlement.round_id.in_(round_ids))
+        }
+
+        payouts = {}  # (user_id, round_id) -> delta
+        for entry in entries:
+            round_id = str(entry['round_id'])
+            if round_id in settled:
+                continue
+            payout = (int(entry['user_id']), round_id)
+            payouts[payout] = payouts.get(payout, 0) + float(entry['delta'])
+    except (KeyError, TypeError, ValueError):
+        return jsonify({"error": "Each entry needs user_id, delta and round_id"}), 400
+
+    # The ledger takes any user id, entries for users that do not exist are dropped here
+    known = {user_id for (user_id,) in
+             db.session.query(User.id).filter(User.id.in_({user_id for user_id, _ in payouts}))}
+    for user_id, round_id in [payout for payout in payouts if payout[0] not in known]:
+        app.logger.warning(f"Dropping the payout of round {round_id} to unknown user {user_id}")
+        del payouts[(user_id, round_id)]
+
+    new_rounds = round_ids - settled
+    if not new_rounds:
+        return jsonify({"status": "Already settled", "applied": 0}), 200
+
+    try:
+        # The primary key on round_id rejects a concurrent duplicate of the same round
+        db.session.add_all(RoundSettlement(round_id=round_id) for round_id in new_rounds)
+        deltas = {}
+        if payouts:
+            deltas = ledger.apply_many(
+                ((user_id, delta, f"round:{round_id}:{user_id}") for (user_id, round_id), delta in payouts.items()),
+                'settlement',
+            )
+        commit_balances(*deltas.keys())
+    except IntegrityError:
+        db.session.rollback()
+        return jsonify({"status": "Already settled", "applied": 0}), 200
+
+    return jsonify({"status": "Settled", "applied": len(deltas)}), 200
+
 @app.route('/user/v1/auth/validate', methods=['GET'])
 @jwt_required()
 def validate():
     user_id = get_jwt_identity()  # Get the user's identity from the token
-    user = User.query.filter_by(id=user_id).first()
-    
+    user = cached_user(user_id)
+
     if user:
-        return jsonify({"status": "valid", "user_id": user.id, "username": user.username}), 200
+        return jsonify({"status": "valid", "user_id": user_id, "username": user['username']}), 200
     return jsonify({"error": "User not found"}), 404
 
 if __name__ == '__main__':
@@ -269,4 +312,5 @@ if __name__ == '__main__':
     service_type = args.serviceType
     service_id = args.serviceIdentifier
     register_service(service_type, service_id)
+    router.start(app, db)
     app.run(host='0.0.0.0', port=5000)
\ No newline at end of file
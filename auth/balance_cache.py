@@ -0,0 +1,73 @@
+""" Write-through cache of each user's balance and username in the auth Redis.
+
+Balance polls, `validate` and the funds check of `prepare` read `user:<id>` instead of
+MySQL. Every balance change bumps `User.version`. After the commit, the row is written to
+the cache only if its version is newer than the cached one, so a slow writer or a read
+that filled the cache from a lagging replica never replaces a newer balance.
+
+Writers also invalidate the entry before they commit. If the write-through fails, the
+next read goes to the database instead of serving the old balance. Entries expire after
+`BALANCE_CACHE_TTL` seconds in any case. A Redis outage only costs database reads.
+"""
+import logging
+
+import redis
+from prometheus_client import Counter
+
+logger = logging.getLogger(__name__)
+
+CACHE_READS = Counter('auth_balance_cache_reads', 'Balance cache lookups', ['result'])
+
+
+class BalanceCache:
+
+    def __init__(self, redis_client, ttl=60):
+        self.redis = redis_client
+        self.ttl = ttl
+
+    @staticmethod
+    def key(user_id):
+        return f"user:{user_id}"
+
+    def get(self, user_id):
+        """ {'username', 'balance'} of the user, or None on a miss. """
+        try:
+            entry = self.redis.hgetall(self.key(user_id))
+        except redis.RedisError as e:
+            logger.warning(f"Balance cache read failed: {e}")
+            CACHE_READS.labels('error').inc()
+            return None
+        if 'balance' not in entry:
+            CACHE_READS.labels('miss').inc()
+            return None
+        CACHE_READS.labels('hit').inc()
+        return {'username': entry['username'], 'balance': float(entry['balance'])}
+
+    def store(self, user):
+        """ Cache the user's committed row unless a newer version is cached. Returns its entry. """
+        entry = {'username': user.username, 'balance': user.balance}
+        try:
+            self.redis.transaction(lambda pipe: self._write(pipe, user.id, user.version, entry), self.key(user.id))
+        except redis.RedisError as e:
+            logger.warning(f"Balance cache write for user {user.id} failed: {e}")
+        return entry
+
+    def _write(self, pipe, user_id, version, entry):
+        key = self.key(user_id)
+        cached = pipe.hget(key, 'version')
+        if cached is not None and int(cached) >= version:
+            return
+        pipe.multi()
+        pipe.delete(key)
+        pipe.hset(key, mapping={'version': version, **entry})
+        pipe.expire(key, self.ttl)
+
+    def invalidate(self, *user_ids):
+        """ Drop the cached rows, keeping their versions so an older row cannot be cached again. """
+        try:
+            pipe = self.redis.pipeline(transaction=False)
+            for user_id in user_ids:
+                pipe.hdel(self.key(user_id), 'username', 'balance')
+            pipe.execute()
+        except redis.RedisError as e:
+            logger.warning(f"Balance cache invalidation failed: {e}")
@@ -1,4 +1,7 @@
 from app import app, db
+from sqlalchemy import inspect, text
+from sqlalchemy.exc import IntegrityError
+import ledger
 import MySQLdb
 
 # Function to create the database if it doesn't exist
@@ -10,10 +13,31 @@ def create_database_if_not_exists():
 
     db.close()
 
+# create_all() only creates missing tables, columns added to existing ones are applied here
+def add_missing_columns():
+    columns = {column['name'] for column in inspect(db.engine).get_columns('user')}
+    if 'version' not in columns:
+        with db.engine.begin() as connection:
+            connection.execute(text("ALTER TABLE `user` ADD COLUMN version INT NOT NULL DEFAULT 0"))
+
+# Users from before the ledger get an opening entry for their balance, so the entries replay to it
+def open_ledger():
+    try:
+        opened = ledger.open_balances()
+        db.session.commit()
+    except IntegrityError:
+        # Another instance opened them first
+        db.session.rollback()
+        return
+    if opened:
+        print(f"Opened the ledger for {opened} existing balances")
+
 with app.app_context():
     try:
         create_database_if_not_exists()
         db.create_all()  # Create tables if they don't exist
+        add_missing_columns()
+        open_ledger()
         print("Database initialized")
     except Exception as e:
         print(f"Error initializing database: {e}")
\ No newline at end of file
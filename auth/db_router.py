@@ -0,0 +1,219 @@
+""" Routes auth service sessions between the MySQL master and its replicas.
+
+Engines (and their connection pools) are the ones Flask-SQLAlchemy creates once from
+SQLALCHEMY_DATABASE_URI and SQLALCHEMY_BINDS. A background health checker keeps each
+replica's up/down state and replication lag, so requests never probe a database. Reads
+of GET requests go to the healthy replica with the fewest sessions in flight relative to
+its weight; everything else, and every read when no replica is usable, goes to the master.
+
+Requests that wrote answer with a consistency token, the master's binlog position after the
+commit. A client that sends it back in `X-Consistency-Token` reads only from a replica that
+has applied the master's log up to that position, so it sees its own writes.
+"""
+import itertools
+import logging
+import threading
+import time
+
+from flask import has_request_context, request
+from flask_sqlalchemy.session import Session
+from prometheus_client import Counter, Gauge
+from sqlalchemy import text
+from sqlalchemy.exc import SQLAlchemyError
+from sqlalchemy.sql.dml import UpdateBase
+
+logger = logging.getLogger(__name__)
+
+MASTER_BIND = 'master'
+CONSISTENCY_HEADER = 'X-Consistency-Token'
+
+REPLICA_HEALTHY = Gauge('auth_replica_healthy', 'Whether the replica serves reads', ['replica'])
+REPLICA_LAG = Gauge('auth_replica_lag_seconds', 'Replication lag reported by the replica', ['replica'])
+REPLICA_SESSIONS = Gauge('auth_replica_sessions', 'Sessions currently reading from the replica', ['replica'])
+TOKEN_READS = Counter('auth_consistent_reads', 'Read sessions that carried a consistency token', ['target'])
+
+
+class Replica:
+
+    def __init__(self, name, weight=1.0):
+        self.name = name
+        self.weight = weight
+        self.healthy = False  # until the first check says otherwise
+        self.lag = None
+        self.position = None  # (master binlog file, position) the replica has applied
+        self.outstanding = 0
+
+
+class ReplicaRouter:
+
+    def __init__(self):
+        self.replicas = {}
+        self.max_lag = 5.0
+        self.check_interval = 2.0
+        self.refresh_interval = 0.05
+        self._lock = threading.Lock()
+        self._checking = threading.Lock()
+        self._checked_at = 0.0
+        self._turn = itertools.count()
+
+    def init_app(self, app):
+        bind_keys = app.config.get('SQLALCHEMY_BINDS', {})
+        weights = app.config.get('REPLICA_WEIGHTS', {})
+        self.replicas = {name: Replica(name, weights.get(name, 1.0)) for name in bind_keys if name != MASTER_BIND}
+        self.max_lag = app.config.get('REPLICA_MAX_LAG', self.max_lag)
+        self.check_interval = app.config.get('REPLICA_CHECK_INTERVAL', self.check_interval)
+        self.refresh_interval = app.config.get('REPLICA_REFRESH_INTERVAL', self.refresh_interval)
+
+    def acquire(self, position=None):
+        """ Name of the replica the next read session should use, or None for the master.
+
+        With a `position` only replicas that applied the master's log up to it are considered.
+        """
+        with self._lock:
+            usable = [
+                replica for replica in self.replicas.values()
+                if replica.healthy and (position is None or (replica.position is not None and replica.position >= position))
+            ]
+            if not usable:
+                return None
+            # Fewest sessions per unit of weight, counting the one being opened; ties go round-robin
+            start = next(self._turn) % len(usable)
+            replica = min(usable[start:] + usable[:start], key=lambda r: (r.outstanding + 1) / r.weight)
+            replica.outstanding += 1
+        REPLICA_SESSIONS.labels(replica.name).inc()
+        return replica.name
+
+    def release(self, name):
+        with self._lock:
+            self.replicas[name].outstanding -= 1
+        REPLICA_SESSIONS.labels(name).dec()
+
+    def check(self, engines):
+        """ Refresh every replica's health, lag and position. `engines` is Flask-SQLAlchemy's bind key -> engine. """
+        with self._checking:
+            self._check(engines)
+
+    def refresh(self, engines):
+        """ Check the replicas now, for a token newer than every known position.
+
+        Skipped (returns False) when a check is already running or ran less than
+        `refresh_interval` ago, so a burst of fresh tokens costs one round of queries.
+        """
+        if time.monotonic() - self._checked_at < self.refresh_interval:
+            return False
+        if not self._checking.acquire(blocking=False):
+            return False
+        try:
+            self._check(engines)
+        finally:
+            self._checking.release()
+        return True
+
+    def _check(self, engines):
+        for replica in self.replicas.values():
+            try:
+                lag, position = replication_state(engines[replica.name])
+                healthy = lag is not None and lag <= self.max_lag
+            except SQLAlchemyError as e:
+                lag, position, healthy = None, None, False
+                if replica.healthy:
+                    logger.warning(f"Replica {replica.name} is down: {e}")
+            if healthy != replica.healthy:
+                logger.info(f"Replica {replica.name} is now {'up' if healthy else 'down'} (lag {lag})")
+            replica.lag, replica.position, replica.healthy = lag, position, healthy
+            REPLICA_HEALTHY.labels(replica.name).set(int(healthy))
+            REPLICA_LAG.labels(replica.name).set(lag if lag is not None else float('nan'))
+        self._checked_at = time.monotonic()
+
+    def watch(self, app, db):
+        """ Keep replica state fresh. Runs forever in a daemon thread. """
+        while True:
+            with app.app_context():
+                self.check(db.engines)
+            time.sleep(self.check_interval)
+
+    def start(self, app, db):
+        with app.app_context():
+            self.check(db.engines)
+        threading.Thread(target=self.watch, args=(app, db), daemon=True, name='replica-health').start()
+
+
+def replication_state(engine):
+    """ (seconds behind the source or None if not replicating, applied position or None). """
+    with engine.connect() as connection:
+        if engine.dialect.name != 'mysql':
+            connection.execute(text("SELECT 1"))
+            return 0.0, None
+        status = connection.execute(text("SHOW REPLICA STATUS")).mappings().first()
+    if status is None:
+        return None, None
+    # Coordinates, in the master's binlog, of the last event the SQL thread executed
+    position = (status['Relay_Source_Log_File'], int(status['Exec_Source_Log_Pos']))
+    if status['Replica_IO_Running'] != 'Yes' or status['Replica_SQL_Running'] != 'Yes':
+        return None, position
+    lag = status['Seconds_Behind_Source']
+    return (float(lag) if lag is not None else None), position
+
+
+def master_position(engine):
+    """ Consistency token covering everything committed on the master so far, None off MySQL. """
+    if engine.dialect.name != 'mysql':
+        return None
+    with engine.connect() as connection:
+        status = connection.execute(text("SHOW MASTER STATUS")).mappings().first()
+    if status is None:
+        return None  # binary logging is off
+    return f"{status['File']}:{status['Position']}"
+
+
+def parse_position(token):
+    """ (binlog file, position) from a consistency token, or None if it is malformed. """
+    file, _, position = token.rpartition(':')
+    if not file or not position.isdigit():
+        return None
+    return file, int(position)
+
+
+router = ReplicaRouter()
+
+
+class RoutingSession(Session):
+    """ Flask-SQLAlchemy session that reads from a replica during GET requests.
+
+    The replica is picked once per session, so a request sees one consistent snapshot.
+    Flushes and INSERT/UPDATE/DELETE statements always go to the master, and mark the
+    session in `info['wrote']` so the response can carry a consistency token.
+    """
+
+    def get_bind(self, mapper=None, clause=None, bind=None, **kwargs):
+        writes = self._flushing or isinstance(clause, UpdateBase)
+        if bind is None and not writes and self._reads_from_replica():
+            if 'replica' not in self.info:
+                self.info['replica'] = self._pick_replica()
+            if self.info['replica'] is not None:
+                return self._db.engines[self.info['replica']]
+        if writes:
+            self.info['wrote'] = True
+        return super().get_bind(mapper=mapper, clause=clause, bind=bind, **kwargs)
+
+    @staticmethod
+    def _reads_from_replica():
+        return has_request_context() and request.method == 'GET'
+
+    def _pick_replica(self):
+        token = request.headers.get(CONSISTENCY_HEADER)
+        if token is None:
+            return router.acquire()
+        position = parse_position(token)
+        # A malformed token says nothing about what the client wrote, only the master is safe
+        replica = router.acquire(position) if position is not None else None
+        if replica is None and position is not None and router.refresh(self._db.engines):
+            replica = router.acquire(position)
+        TOKEN_READS.labels('replica' if replica is not None else 'master').inc()
+        return replica
+
+    def close(self):
+        replica = self.info.pop('replica', None)
+        if replica is not None:
+            router.release(replica)
+        super().close()
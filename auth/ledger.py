@@ -0,0 +1,96 @@
+""" Append-only ledger of balance changes.
+
+Every balance change is a BalanceEntry row. `User.balance` is the materialised sum of the
+user's entries, moved in the same transaction by `UPDATE user SET balance = balance + delta`.
+Nothing loads the row before changing it, so concurrent payouts to one account cannot lose
+updates, and the row lock is only held from that UPDATE to the commit.
+
+An entry may carry an idempotency key, unique across the ledger. A retry with a used key
+fails on the INSERT, before the user row is touched, with IntegrityError.
+
+Balances from before the ledger are recorded as one `opening` entry per user when the
+table is created (db_init.py).
+
+Replaying the entries must give every balance back:
+
+    python ledger.py
+"""
+from sqlalchemy import String, case, cast, exists, func, insert, literal, select, update
+
+from models import db, User, BalanceEntry
+
+
+def apply(user_id, delta, kind, idempotency_key=None):
+    """ Record a change of `delta` and apply it. Returns False if there is no such user. The caller commits. """
+    db.session.execute(insert(BalanceEntry).values(user_id=user_id, delta=delta, kind=kind,
+                                                   idempotency_key=idempotency_key))
+    result = db.session.execute(
+        update(User)
+        .where(User.id == user_id)
+        .values(balance=User.balance + delta, version=User.version + 1)
+        .execution_options(synchronize_session=False)
+    )
+    return result.rowcount == 1
+
+
+def apply_many(entries, kind):
+    """ Record and apply (user_id, delta, idempotency key) entries in one INSERT and one UPDATE. The caller commits. """
+    entries = list(entries)
+    db.session.execute(insert(BalanceEntry), [
+        {'user_id': user_id, 'delta': delta, 'kind': kind, 'idempotency_key': key} for user_id, delta, key in entries
+    ])
+    deltas = {}
+    for user_id, delta, _ in entries:
+        deltas[user_id] = deltas.get(user_id, 0) + delta
+    db.session.execute(
+        update(User)
+        .where(User.id.in_(deltas.keys()))
+        .values(balance=User.balance + case(deltas, value=User.id), version=User.version + 1)
+        .execution_options(synchronize_session=False)
+    )
+    return deltas
+
+
+def set_balance(user_id, balance, idempotency_key=None):
+    """ Move the balance to an absolute value, recorded as the difference. Returns False if there is no such user. """
+    # The difference depends on the current balance, so this one change does lock the row first
+    row = db.session.execute(select(User.balance).where(User.id == user_id).with_for_update()).first()
+    if row is None:
+        return False
+    return apply(user_id, balance - (row.balance or 0), 'set', idempotency_key)
+
+
+def open_balances():
+    """ Record an opening entry for every balance from before the ledger. Returns how many. The caller commits. """
+    result = db.session.execute(
+        insert(BalanceEntry).from_select(
+            ['user_id', 'delta', 'kind', 'idempotency_key'],
+            select(User.id, User.balance, literal('opening'), literal('opening:') + cast(User.id, String))
+            .where(User.balance != 0, ~exists().where(BalanceEntry.user_id == User.id)),
+        )
+    )
+    return result.rowcount
+
+
+def mismatches(tolerance=1e-6):
+    """ (user id, balance, replayed balance) of every user whose balance differs from the sum of its entries. """
+    replayed = (
+        select(BalanceEntry.user_id, func.sum(BalanceEntry.delta).label('total'))
+        .group_by(BalanceEntry.user_id)
+        .subquery()
+    )
+    rows = db.session.execute(
+        select(User.id, User.balance, func.coalesce(replayed.c.total, 0))
+        .outerjoin(replayed, replayed.c.user_id == User.id)
+    ).all()
+    return [(user_id, balance, total) for user_id, balance, total in rows if abs((balance or 0) - total) > tolerance]
+
+
+if __name__ == '__main__':
+    from app import app
+
+    with app.app_context():
+        rows = mismatches()
+    for user_id, balance, total in rows:
+        print(f"user {user_id}: balance {balance}, entries sum to {total}")
+    print(f"{len(rows)} balance(s) differ from the ledger")
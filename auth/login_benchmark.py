@@ -0,0 +1,110 @@
+""" Login throughput and cheap-endpoint latency during a login storm.
+
+Runs the auth app in this process on a throwaway SQLite database. It first measures
+password verifications per second on one core, then, once with hashing on the request
+threads and once through the hashing pool, runs `--threads` threads that log in as fast
+as they can while another thread times `GET /user/v1/status`:
+
+    python login_benchmark.py --threads 200 --duration 10 --workers 3
+"""
+import argparse
+import os
+import tempfile
+import threading
+import time
+
+
+def percentile(samples, q):
+    if not samples:
+        return float('nan')
+    samples = sorted(samples)
+    return samples[min(int(len(samples) * q), len(samples) - 1)]
+
+
+def per_core_rate(rounds, seconds=2.0):
+    """ Verifications per second on the calling thread. """
+    from password_hashing import hash_password, verify_password
+
+    password_hash = hash_password('benchmark', rounds)
+    done, start = 0, time.perf_counter()
+    while time.perf_counter() - start < seconds:
+        verify_password('benchmark', password_hash, rounds)
+        done += 1
+    return done / (time.perf_counter() - start)
+
+
+def storm(app, threads, duration):
+    """ (logins/sec, rejections/sec, status latencies in seconds). """
+    stop = threading.Event()
+    counts = {'ok': 0, 'busy': 0}
+    lock = threading.Lock()
+    latencies = []
+
+    def login():
+        client = app.test_client()
+        while not stop.is_set():
+            response = client.post('/user/v1/auth/login', json={'username': 'benchmark', 'password': 'benchmark'})
+            outcome = 'busy' if response.status_code == 503 else 'ok'
+            with lock:
+                counts[outcome] += 1
+
+    def probe():
+        client = app.test_client()
+        while not stop.is_set():
+            start = time.perf_counter()
+            client.get('/user/v1/status')
+            latencies.append(time.perf_counter() - start)
+            time.sleep(0.005)
+
+    workers = [threading.Thread(target=login, daemon=True) for _ in range(threads)]
+    workers.append(threading.Thread(target=probe, daemon=True))
+    for thread in workers:
+        thread.start()
+    time.sleep(duration)
+    stop.set()
+    for thread in workers:
+        thread.join()
+    return counts['ok'] / duration, counts['busy'] / duration, latencies
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Login throughput benchmark for the auth service')
+    parser.add_argument('--threads', type=int, default=100, help='Concurrent logins')
+    parser.add_argument('--duration', type=float, default=10, help='Seconds per storm')
+    parser.add_argument('--workers', type=int, help='Hashing processes, the service default if omitted')
+    parser.add_argument('--queue', type=int, help='Hashes that may wait for a worker, the service default if omitted')
+    parser.add_argument('--rounds', type=int, help='pbkdf2_sha256 rounds, the service default if omitted')
+    args = parser.parse_args()
+
+    from config import Config
+
+    Config.SQLALCHEMY_DATABASE_URI = f"sqlite:///{os.path.join(tempfile.mkdtemp(), 'auth.db')}"
+    Config.SQLALCHEMY_BINDS = {}
+    Config.SQLALCHEMY_ENGINE_OPTIONS = {}
+    for name, value in (('PASSWORD_HASH_WORKERS', args.workers), ('PASSWORD_HASH_QUEUE', args.queue),
+                        ('PASSWORD_HASH_ROUNDS', args.rounds)):
+        if value is not None:
+            setattr(Config, name, value)
+
+    from app import app, db
+    from password_hashing import hasher
+
+    with app.app_context():
+        db.create_all()
+    app.test_client().post('/user/v1/auth/register', json={'username': 'benchmark', 'password': 'benchmark'})
+
+    per_core = per_core_rate(hasher.rounds)
+    print(f"pbkdf2_sha256, {hasher.rounds} rounds: {per_core:.1f} logins/sec per core")
+
+    pool_workers = hasher.workers
+    for mode, workers in (('request threads', 0), (f'pool of {pool_workers}', pool_workers)):
+        hasher.workers = workers
+        logins, rejected, latencies = storm(app, args.threads, args.duration)
+        cores = max(workers, 1)
+        print(f"{mode}: {logins:.1f} logins/sec ({logins / cores:.1f} per core), {rejected:.1f} rejected/sec, "
+              f"status p50 {percentile(latencies, 0.5) * 1000:.1f} ms "
+              f"p99 {percentile(latencies, 0.99) * 1000:.1f} ms over {len(latencies)} calls")
+
+
+if __name__ == '__main__':
+    main()
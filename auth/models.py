@@ -1,16 +1,44 @@
 from flask_sqlalchemy import SQLAlchemy
-from passlib.hash import pbkdf2_sha256
+from password_hashing import hasher
+from db_router import RoutingSession
 
-db = SQLAlchemy()
+db = SQLAlchemy(session_options={'class_': RoutingSession})
 
 class User(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     username = db.Column(db.String(80), unique=True, nullable=False)
     password_hash = db.Column(db.String(200), nullable=False)
+    # Sum of the user's BalanceEntry rows, only ever changed through ledger.py
     balance = db.Column(db.Float, default=0)
+    # Bumped with every balance change, orders the writes to the balance cache
+    version = db.Column(db.Integer, nullable=False, default=0, server_default='0')
 
+    # Both hash in the password pool, see password_hashing.py, and may raise HashingBusy
     def set_password(self, password):
-        self.password_hash = pbkdf2_sha256.hash(password)
+        self.password_hash = hasher.hash(password)
 
     def check_password(self, password):
-        return pbkdf2_sha256.verify(password, self.password_hash)
\ No newline at end of file
+        valid, new_hash = hasher.verify(password, self.password_hash)
+        if new_hash:
+            self.password_hash = new_hash  # hashed with outdated rounds, the caller commits
+        return valid
+
+class RoundSettlement(db.Model):
+    # One row per game round whose payouts were applied, makes batch settlement idempotent
+    round_id = db.Column(db.String(128), primary_key=True)
+    settled_at = db.Column(db.DateTime, server_default=db.func.now())
+
+class BalanceEntry(db.Model):
+    # Append-only history of balance changes, see ledger.py
+    id = db.Column(db.BigInteger().with_variant(db.Integer, 'sqlite'), primary_key=True)
+    # No foreign key: checking it would lock the user row the entry is about to update
+    user_id = db.Column(db.Integer, nullable=False)
+    delta = db.Column(db.Float, nullable=False)
+    kind = db.Column(db.String(16), nullable=False)  # opening, set, update, commit or settlement
+    idempotency_key = db.Column(db.String(191), nullable=True)  # unique where set, scoped by the caller
+    created_at = db.Column(db.DateTime, server_default=db.func.now())
+
+    __table_args__ = (
+        db.Index('ix_balance_entry_user_id', 'user_id', 'id'),
+        db.Index('ix_balance_entry_idempotency_key', 'idempotency_key', unique=True),
+    )
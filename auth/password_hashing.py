@@ -0,0 +1,118 @@
+""" Password hashing off the request threads.
+
+pbkdf2 is pure CPU, so hashing on a Flask request thread holds the GIL for the whole
+digest and a login storm starves every other request. Hashes and verifications run in
+a small process pool instead. Request threads only wait on the result.
+
+At most `PASSWORD_HASH_WORKERS + PASSWORD_HASH_QUEUE` operations are in flight per
+instance. Beyond that a call fails straight away with HashingBusy (a 503), rather than
+queueing logins that would time out anyway.
+
+A stored hash whose rounds differ from `PASSWORD_HASH_ROUNDS` is rehashed on the next
+successful login, so changing the rounds needs no migration.
+"""
+from concurrent.futures import ProcessPoolExecutor, TimeoutError
+from concurrent.futures.process import BrokenProcessPool
+import multiprocessing
+import threading
+
+from passlib.hash import pbkdf2_sha256
+from prometheus_client import Counter, Gauge, Histogram
+
+HASH_SECONDS = Histogram('auth_password_hash_seconds', 'Time a request waited for a password hash', ['operation'])
+HASH_PENDING = Gauge('auth_password_hash_pending', 'Password hashes running or queued')
+HASH_REJECTED = Counter('auth_password_hash_rejected', 'Password hashes refused because the pool was full')
+
+
+class HashingBusy(Exception):
+    """ Raised when the instance already has as many hashes in flight as it allows. """
+
+
+def hash_password(password, rounds):
+    return pbkdf2_sha256.using(rounds=rounds).hash(password)
+
+
+def verify_password(password, password_hash, rounds):
+    """ (valid, new hash if the stored one should be replaced, else None). """
+    if not pbkdf2_sha256.verify(password, password_hash):
+        return False, None
+    if pbkdf2_sha256.from_string(password_hash).rounds != rounds:
+        return True, hash_password(password, rounds)
+    return True, None
+
+
+class PasswordHasher:
+
+    def __init__(self):
+        self.rounds = pbkdf2_sha256.default_rounds
+        self.workers = 0  # 0 hashes on the calling thread
+        self.timeout = 10.0
+        self._slots = threading.BoundedSemaphore(1)
+        self._pool = None
+        self._pool_lock = threading.Lock()
+
+    def init_app(self, app):
+        self.rounds = app.config.get('PASSWORD_HASH_ROUNDS', self.rounds)
+        self.workers = app.config.get('PASSWORD_HASH_WORKERS', self.workers)
+        self.timeout = app.config.get('PASSWORD_HASH_TIMEOUT', self.timeout)
+        self._slots = threading.BoundedSemaphore(max(self.workers, 1) + app.config.get('PASSWORD_HASH_QUEUE', 0))
+
+    def hash(self, password):
+        return self._run('hash', hash_password, password, self.rounds)
+
+    def verify(self, password, password_hash):
+        """ (valid, new hash if the stored one should be replaced, else None). """
+        return self._run('verify', verify_password, password, password_hash, self.rounds)
+
+    def _run(self, operation, fn, *args):
+        if not self._slots.acquire(blocking=False):
+            HASH_REJECTED.inc()
+            raise HashingBusy()
+        HASH_PENDING.inc()
+        with HASH_SECONDS.labels(operation).time():
+            if not self.workers:
+                try:
+                    return fn(*args)
+                finally:
+                    self._release()
+            try:
+                future = self._executor().submit(fn, *args)
+            except BrokenProcessPool:
+                self._release()
+                self._reset()
+                raise HashingBusy()
+            except BaseException:
+                self._release()
+                raise
+            # The slot is freed when the worker is done, not when this request stops waiting
+            future.add_done_callback(lambda _: self._release())
+            try:
+                return future.result(timeout=self.timeout)
+            except TimeoutError:
+                raise HashingBusy()
+            except BrokenProcessPool:
+                self._reset()
+                raise HashingBusy()
+
+    def _release(self):
+        HASH_PENDING.dec()
+        self._slots.release()
+
+    def _reset(self):
+        """ A worker died and took the pool down, the next call starts a fresh one. """
+        with self._pool_lock:
+            self._pool = None
+
+    def _executor(self):
+        with self._pool_lock:
+            if self._pool is None:
+                # Workers are forked from a fork server rather than from this process, whose threads
+                # may hold locks mid-request. The server imports the main module (without running its
+                # __main__ block) and this one once, so a new worker does not import either again
+                context = multiprocessing.get_context('forkserver')
+                context.set_forkserver_preload(['__main__', __name__])
+                self._pool = ProcessPoolExecutor(max_workers=self.workers, mp_context=context)
+            return self._pool
+
+
+hasher = PasswordHasher()
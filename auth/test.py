@@ -1,5 +1,18 @@
+import threading
+import time
 import unittest
+from types import SimpleNamespace
+
+import fakeredis
+from prometheus_client import REGISTRY
+
+import app as auth_service
 from app import app, db
+from models import User, BalanceEntry
+from db_router import ReplicaRouter, Replica, parse_position
+from password_hashing import hasher
+from balance_cache import BalanceCache
+import ledger
 
 class AuthServiceTestCase(unittest.TestCase):
 
@@ -9,6 +22,7 @@ class AuthServiceTestCase(unittest.TestCase):
         app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///:memory:'  # Use in-memory database for tests
         app.config['JWT_SECRET_KEY'] = 'test-secret'
         cls.client = app.test_client()
+        auth_service.balance_cache = BalanceCache(fakeredis.FakeStrictRedis(decode_responses=True))
 
         with app.app_context():  # Create application context
             db.create_all()  # Create the database schema for tests
@@ -80,6 +94,156 @@ class AuthServiceTestCase(unittest.TestCase):
         self.assertEqual(response.json['status'], 'valid')
         self.assertEqual(response.json['username'], 'validuser')
 
+    def test_batch_balance(self):
+        user_ids = []
+        for username in ('batchuser1', 'batchuser2'):
+            self.client.post('/user/v1/auth/register', json={'username': username, 'password': 'pass'})
+            response = self.client.post('/user/v1/auth/login', json={'username': username, 'password': 'pass'})
+            auth_token = response.json['access_token']
+            self.client.post('/user/v1/balance', json={'balance': 100}, headers={'Authorization': f'Bearer {auth_token}'})
+            response = self.client.get('/user/v1/auth/validate', headers={'Authorization': f'Bearer {auth_token}'})
+            user_ids.append(response.json['user_id'])
+
+        entries = [
+            {'user_id': user_ids[0], 'delta': 25, 'round_id': '1:abc'},
+            {'user_id': user_ids[0], 'delta': 5, 'round_id': '1:abc'},
+            {'user_id': user_ids[1], 'delta': 50, 'round_id': '1:abc'},
+        ]
+        response = self.client.post('/user/v1/balance/batch', json={'entries': entries})
+        self.assertEqual(response.status_code, 401)
+
+        headers = {'X-Service-Token': app.config['SERVICE_TOKEN']}
+        response = self.client.post('/user/v1/balance/batch', json={'entries': entries}, headers=headers)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json['applied'], 2)
+
+        # Replaying the same round must not pay out twice
+        response = self.client.post('/user/v1/balance/batch', json={'entries': entries}, headers=headers)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json['applied'], 0)
+
+        with app.app_context():
+            self.assertEqual(db.session.get(User, user_ids[0]).balance, 130)
+            self.assertEqual(db.session.get(User, user_ids[1]).balance, 150)
+
+        # Payouts to users that do not exist are not applied
+        entries = [{'user_id': user_ids[0], 'delta': 10, 'round_id': '2:def'},
+                   {'user_id': 999999, 'delta': 10, 'round_id': '2:def'}]
+        response = self.client.post('/user/v1/balance/batch', json={'entries': entries}, headers=headers)
+        self.assertEqual(response.json['applied'], 1)
+        with app.app_context():
+            self.assertEqual(db.session.query(BalanceEntry).filter_by(user_id=999999).count(), 0)
+
+    def test_replica_router(self):
+        router = ReplicaRouter()
+        router.replicas = {name: Replica(name) for name in ('replica1', 'replica2')}
+
+        # Until a health check marks a replica up, reads go to the master
+        self.assertIsNone(router.acquire())
+
+        for replica in router.replicas.values():
+            replica.healthy = True
+        first, second = router.acquire(), router.acquire()
+        self.assertNotEqual(first, second)
+        router.release(first)
+        router.release(second)
+
+        router.replicas['replica2'].healthy = False
+        self.assertEqual(router.acquire(), 'replica1')
+
+    def test_consistency_token(self):
+        router = ReplicaRouter()
+        router.replicas = {name: Replica(name) for name in ('replica1', 'replica2')}
+        for replica in router.replicas.values():
+            replica.healthy = True
+        router.replicas['replica1'].position = ('mysql-bin.000001', 900)
+        router.replicas['replica2'].position = ('mysql-bin.000002', 120)
+
+        # Only a replica that applied the master's log up to the token may serve the read
+        self.assertEqual(router.acquire(parse_position('mysql-bin.000002:100')), 'replica2')
+        self.assertIsNone(router.acquire(parse_position('mysql-bin.000002:500')))
+        self.assertIsNone(parse_position('not-a-token'))
+
+    def test_password_rehash(self):
+        self.client.post('/user/v1/auth/register', json={'username': 'rehashuser', 'password': 'pass'})
+        rounds = hasher.rounds
+        hasher.rounds = rounds + 1000
+        try:
+            response = self.client.post('/user/v1/auth/login', json={'username': 'rehashuser', 'password': 'pass'})
+            self.assertEqual(response.status_code, 200)
+        finally:
+            hasher.rounds = rounds
+
+        # The stored hash now uses the new rounds, and still verifies
+        with app.app_context():
+            password_hash = User.query.filter_by(username='rehashuser').first().password_hash
+        self.assertIn(f'${rounds + 1000}$', password_hash)
+        response = self.client.post('/user/v1/auth/login', json={'username': 'rehashuser', 'password': 'pass'})
+        self.assertEqual(response.status_code, 200)
+
+    def test_login_busy(self):
+        self.client.post('/user/v1/auth/register', json={'username': 'busyuser', 'password': 'pass'})
+        # A single hashing slot, held by a slow hash on another thread
+        saved = {name: app.config[name] for name in ('PASSWORD_HASH_WORKERS', 'PASSWORD_HASH_QUEUE', 'PASSWORD_HASH_ROUNDS')}
+        app.config.update(PASSWORD_HASH_WORKERS=0, PASSWORD_HASH_QUEUE=0, PASSWORD_HASH_ROUNDS=1000000)
+        hasher.init_app(app)
+        slow = threading.Thread(target=hasher.hash, args=('slow',))
+        try:
+            slow.start()
+            while not REGISTRY.get_sample_value('auth_password_hash_pending'):
+                time.sleep(0.001)
+            response = self.client.post('/user/v1/auth/login', json={'username': 'busyuser', 'password': 'pass'})
+        finally:
+            slow.join()
+            app.config.update(saved)
+            hasher.init_app(app)
+        self.assertEqual(response.status_code, 503)
+        self.assertEqual(response.headers['Retry-After'], '1')
+
+    def test_balance_cache(self):
+        self.client.post('/user/v1/auth/register', json={'username': 'cacheuser', 'password': 'pass'})
+        response = self.client.post('/user/v1/auth/login', json={'username': 'cacheuser', 'password': 'pass'})
+        headers = {'Authorization': f"Bearer {response.json['access_token']}"}
+        self.client.post('/user/v1/balance', json={'balance': 100}, headers=headers)
+
+        # Reads are served from the cache, written through by the update
+        with app.app_context():
+            user = User.query.filter_by(username='cacheuser').first()
+            user_id, version = user.id, user.version
+            db.session.execute(db.update(User).where(User.id == user_id).values(balance=0))
+            db.session.commit()
+        response = self.client.get('/user/v1/balance', headers=headers)
+        self.assertEqual(response.json['balance'], 100)
+
+        # A row older than the cached one is not written over it
+        auth_service.balance_cache.store(SimpleNamespace(id=user_id, username='cacheuser', balance=5, version=version - 1))
+        response = self.client.get('/user/v1/balance', headers=headers)
+        self.assertEqual(response.json['balance'], 100)
+
+        response = self.client.put('/user/v1/balance', json={'amount': 50}, headers=headers)
+        self.assertEqual(response.status_code, 200)
+        response = self.client.get('/user/v1/balance', headers=headers)
+        self.assertEqual(response.json['balance'], 50)
+
+    def test_balance_ledger(self):
+        self.client.post('/user/v1/auth/register', json={'username': 'ledgeruser', 'password': 'pass'})
+        response = self.client.post('/user/v1/auth/login', json={'username': 'ledgeruser', 'password': 'pass'})
+        headers = {'Authorization': f"Bearer {response.json['access_token']}"}
+        self.client.post('/user/v1/balance', json={'balance': 100}, headers=headers)
+
+        # A retried change with the same idempotency key is applied once
+        for _ in range(2):
+            response = self.client.put('/user/v1/balance', json={'amount': -30},
+                                       headers={**headers, 'Idempotency-Key': 'bet-1'})
+            self.assertEqual(response.status_code, 200)
+        response = self.client.get('/user/v1/balance', headers=headers)
+        self.assertEqual(response.json['balance'], 70)
+
+        # Replaying the user's entries gives the balance back
+        with app.app_context():
+            user_id = User.query.filter_by(username='ledgeruser').first().id
+            self.assertNotIn(user_id, [row[0] for row in ledger.mismatches()])
+
     def test_status(self):
         response = self.client.get('/user/v1/status')
         self.assertEqual(response.status_code, 200)
@@ -1,18 +1,32 @@
 from flask import Flask, request, jsonify, abort
-from flask_socketio import SocketIO, emit
-from models import db, Lobby, Bet
+from flask_socketio import SocketIO, emit, join_room
+from flask_migrate import Migrate
+from models import db, Lobby, Bet, Round
 from config import Config
-import hashlib
+from token_cache import TokenCache, decode_token
+from settlement import BetBook, SettlementBuffer, settle_round
+from history import archive_rounds, finished_rounds, round_bets
+from bet_queue import BetQueue
+from engine import RoundScheduler
+from game_metrics import ACTIVE_LOBBIES, ACTIVE_ROUNDS, SOCKETS, tick_phase, timed_event
+from lobby_cache import LobbyCache, BETTING, RUNNING, CRASHED
+from fairness import chain_for, crash_point_from_hash, crash_points, new_chain, verify_crash_points
+from protocol import (STREAM, CURVE, PROTOCOLS, JSON, available_encodings, curve_params,
+                      encode_frame, lobby_room, user_room)
 import random
-import hmac
 import time
-import threading
 import os
+from redis_ring import RedisRing, parse_nodes
+from resharding import Resharder, MEMBERSHIP_KEY, MIGRATOR_LOCK_KEY
+from placement import Placement, REGISTRY_KEY, DRAINING_KEY
 import redis
-from hashring import HashRing
 import requests
+import jwt
+from http_client import service_client
 import argparse
 from prometheus_flask_exporter import PrometheusMetrics
+from sqlalchemy import exists, func, select, update
+from sqlalchemy.exc import SQLAlchemyError
 import logging
 
 app = Flask(__name__)
@@ -21,30 +35,63 @@ app.config.from_object(Config)
 metrics = PrometheusMetrics(app)
 
 db.init_app(app)
+migrate = Migrate(app, db)
 
 port = None
 
-# Connect to Redis
-#redis_client = redis.StrictRedis(host='redis', port=6379, db=0, decode_responses=True)
-nodes = {
-    'redis-node-1': {'host': 'redis-node-1', 'port': 6379},
-    'redis-node-2': {'host': 'redis-node-2', 'port': 6379},
-    'redis-node-3': {'host': 'redis-node-3', 'port': 6379},
-}
+# Connect to Redis. Membership may change at runtime, see resharding.py
+LOBBY_INVALIDATE_CHANNEL = 'lobby_invalidate'
+redis_ring = RedisRing(parse_nodes(app.config['REDIS_NODES']), max_connections=app.config['REDIS_POOL_SIZE'],
+                       pool_timeout=app.config['REDIS_POOL_TIMEOUT'],
+                       pinned=(MEMBERSHIP_KEY, MIGRATOR_LOCK_KEY, LOBBY_INVALIDATE_CHANNEL, REGISTRY_KEY, DRAINING_KEY))
+redis_clients = redis_ring.clients
+resharder = Resharder(redis_ring, poll_interval=app.config['RING_POLL_INTERVAL'],
+                      batch_size=app.config['RING_MIGRATE_BATCH'], pause=app.config['RING_MIGRATE_PAUSE'])
+placement = Placement(redis_ring, weights=app.config['PLACEMENT_WEIGHTS'], node_ttl=app.config['PLACEMENT_NODE_TTL'],
+                      slack=app.config['PLACEMENT_SLACK'])
 
-redis_clients = {name: redis.Redis(**config) for name, config in nodes.items()}
+def get_redis_client(key):
+    return redis_ring.client_for(key)
 
-ring = HashRing(redis_clients.keys())
+def load_lobby_state(lobby_id):
+    """ Lobby cache miss: read the lobby from the database. """
+    lobby = db.session.get(Lobby, lobby_id)
+    if not lobby:
+        return None
+    return {'port': lobby.port, 'phase': RUNNING if lobby.in_progress else BETTING, 'round_id': lobby.current_round_id}
 
-def get_redis_client(key):
-    node_name = ring.get_node(key)
-    return redis_clients[node_name]
+# Lobby metadata and round phase, so bet admission does not hit MySQL
+lobby_cache = LobbyCache(redis_ring, load_lobby_state, channel=LOBBY_INVALIDATE_CHANNEL, max_size=app.config['LOBBY_CACHE_SIZE'],
+                         local_ttl=app.config['LOBBY_CACHE_LOCAL_TTL'])
+
+# Bets from the saga, written to the database behind the HTTP response
+bet_queue = BetQueue(redis_ring, batch_size=app.config['BET_FLUSH_BATCH_SIZE'],
+                     refund=lambda ingest_id, user_id, amount: refund_bet(ingest_id, user_id, amount))
+
+socketio = SocketIO(app, cors_allowed_origins='*', message_queue=app.config['SOCKETIO_MESSAGE_QUEUE'])
+
+# Every round in this process is stepped by one scheduler thread
+scheduler = RoundScheduler(max_rounds=app.config['MAX_ACTIVE_ROUNDS'], context=app.app_context,
+                           start_background_task=socketio.start_background_task,
+                           prepare=lambda lobby_ids: prefetch_withdrawals(lobby_ids))
 
-socketio = SocketIO(app, cors_allowed_origins='*')
+# Lobbies whose round got past the countdown. Entries of failed rounds are ignored once the
+# scheduler drops them, and cleared when the lobby's next round starts
+running_lobbies = set()
+ACTIVE_LOBBIES.set_function(lambda: len(scheduler))
+ACTIVE_ROUNDS.set_function(lambda: sum(scheduler.is_active(lobby_id) for lobby_id in list(running_lobbies)))
+SOCKETS.set_function(lambda: placement.sockets)
 
-salt = "0000000000000000000fa3b65e43e4240d71762a5bf397d5304b2596d116859c"
+AUTH_SERVICE_URL = app.config['GATEWAY_URL']
+AUTH_INTERNAL_URL = app.config['AUTH_URL']
 
-AUTH_SERVICE_URL = "http://gateway:8080"
+# Shared keep-alive clients, every outbound call goes through one of these
+http_options = dict(pool_size=app.config['HTTP_POOL_SIZE'], connect_timeout=app.config['HTTP_CONNECT_TIMEOUT'],
+                    read_timeout=app.config['HTTP_READ_TIMEOUT'])
+gateway_client = service_client('gateway', AUTH_SERVICE_URL, **http_options)
+auth_client = service_client('auth', AUTH_INTERNAL_URL, **http_options)
+
+token_cache = TokenCache(max_size=app.config['TOKEN_CACHE_SIZE'], ttl=app.config['TOKEN_CACHE_TTL'])
 
 @app.route('/metrics')
 def metrics():
@@ -52,8 +99,6 @@ def metrics():
 
 # Register service with Service Discovery
 def register_service(service_type, service_id, retries=5, delay=5):
-    discovery_url = "http://gateway:8080/discovery/register"
-
     registration_payload = {
         "serviceType": service_type,
         "serviceUrl": f"http://{service_type}_{service_id}:5000"
@@ -61,7 +106,7 @@ def register_service(service_type, service_id, retries=5, delay=5):
 
     for attempt in range(retries):
         try:
-            response = requests.post(discovery_url, json=registration_payload)
+            response = gateway_client.post("/discovery/register", json=registration_payload)
             print("request went nice")
             return
         except requests.exceptions.RequestException as e:
@@ -72,10 +117,37 @@ def register_service(service_type, service_id, retries=5, delay=5):
     print("Service registration failed after maximum retries.")
 
 def validate_token(token):
-    """ Validate JWT token with the auth service and retrieve user information. """
-    response = requests.get(f"{AUTH_SERVICE_URL}/gateway/user/v1/auth/validate", headers={"Authorization": f"Bearer {token}"})
+    """ Validate JWT token and retrieve user information.
+
+    Identities are served from the local cache when possible. On a miss the token is
+    verified in-process with the shared signing key, and only when no key is configured
+    do we fall back to a round trip to the auth service.
+    """
+    user_info = token_cache.get(token)
+    if user_info:
+        return user_info
+
+    key = app.config.get('JWT_SECRET_KEY')
+    if key:
+        claims = decode_token(token, key, [app.config['JWT_ALGORITHM']])
+        if not claims:
+            return None
+        user_info = {"status": "valid", "user_id": claims['sub']}
+        token_cache.set(token, user_info, claims['exp'])
+        return user_info
+
+    try:
+        response = gateway_client.get("/gateway/user/v1/auth/validate", headers={"Authorization": f"Bearer {token}"})
+    except requests.exceptions.RequestException:
+        return None
     if response.status_code == 200:
-        return response.json()
+        user_info = response.json()
+        try:
+            exp = jwt.decode(token, options={"verify_signature": False}).get('exp')
+        except jwt.InvalidTokenError:
+            exp = None
+        token_cache.set(token, user_info, exp)
+        return user_info
     return None
 
 @app.route('/game/v1/status', methods=['GET'])
@@ -98,18 +170,22 @@ def join_lobby():
 
     # Check if lobby_id is provided and not None
     if lobby_id:
-        # Check if the lobby exists in the database
-        lobby = db.session.get(Lobby, lobby_id)
+        # Check if the lobby exists
+        lobby = lobby_cache.get(int(lobby_id))
     else:
         lobby = None
 
     if not lobby:
         # Create a new lobby if it doesn't exist
-        initial_hash = create_initial_hash()
-        new_lobby = Lobby(initial_hash=initial_hash, current_hash=initial_hash, port=port)
+        new_lobby = Lobby(port=port)
+        start_chain(new_lobby)
         db.session.add(new_lobby)
+        db.session.flush()
+        new_lobby.port = place_lobby(new_lobby.id)
+        open_round(new_lobby)
         db.session.commit()
         lobby_id = new_lobby.id
+        lobby_cache.set(lobby_id, port=new_lobby.port, phase=BETTING, round_id=new_lobby.current_round_id)
 
     # Provide the lobby ID and WebSocket URL to the client
     return jsonify({
@@ -118,33 +194,227 @@ def join_lobby():
 
 @app.route('/game/v1/lobby/<int:lobby_id>', methods=['GET'])
 def get_lobby(lobby_id):
-    lobby = db.session.get(Lobby, lobby_id)
+    lobby = lobby_cache.get(lobby_id)
     if not lobby:
         abort(404)
     
-    return jsonify({'websocket_url': f"http://localhost:{lobby.port}"})
+    return jsonify({'websocket_url': f"http://localhost:{lobby['port']}"})
+
+def place_lobby(lobby_id, exclude=()):
+    """ Port of the replica a lobby should live on, this one if placement has nothing to go on. """
+    try:
+        chosen = placement.choose(f"lobby:{lobby_id}", exclude)
+    except redis.exceptions.RedisError as e:
+        app.logger.warning(f"Lobby placement unavailable, keeping lobby {lobby_id} here: {e}")
+        chosen = None
+    return chosen if chosen is not None else port
+
+def start_chain(lobby):
+    """ Give the lobby a fresh hash chain and put it on the chain's first round. The caller commits. """
+    length = app.config['CHAIN_LENGTH']
+    lobby.initial_hash, lobby.chain_commitment = new_chain(length)
+    lobby.chain_length, lobby.round_index = length, 0
+    lobby.current_hash = chain_for(lobby.initial_hash).hash_at(length - 1)
+
+def advance_chain(lobby):
+    """ Move the lobby's current hash back one step along its chain, or to a new chain once this one is played out. """
+    if lobby.chain_length is None or lobby.round_index + 1 >= lobby.chain_length:
+        start_chain(lobby)
+        return
+    lobby.round_index += 1
+    lobby.current_hash = chain_for(lobby.initial_hash).hash_at(lobby.chain_length - 1 - lobby.round_index)
+
+def open_round(lobby):
+    """ Create the round new bets in the lobby are placed on. The caller commits. """
+    game_round = Round(lobby_id=lobby.id, hash=lobby.current_hash)
+    db.session.add(game_round)
+    db.session.flush()
+    lobby.current_round_id = game_round.id
+    return game_round
+
+def round_json(game_round):
+    # Chains are played backwards, so a played round's hash says nothing about the next one.
+    # The hash of a round not yet ended is its crash point, and is never sent
+    ended = game_round.ended_at is not None
+    return {
+        'round_id': game_round.id,
+        'hash': game_round.hash if ended else None,
+        'crash_point': game_round.crash_point,
+        'started_at': game_round.started_at.isoformat() if game_round.started_at else None,
+        'ended_at': game_round.ended_at.isoformat() if game_round.ended_at else None,
+    }
+
+def page_args(cursor_name):
+    """ (cursor, limit) from the query string, or raises ValueError. """
+    cursor = request.args.get(cursor_name)
+    limit = int(request.args.get('limit', app.config['HISTORY_PAGE_SIZE']))
+    if not 0 < limit <= app.config['HISTORY_MAX_PAGE_SIZE']:
+        raise ValueError(f"limit must be between 1 and {app.config['HISTORY_MAX_PAGE_SIZE']}")
+    return (int(cursor) if cursor is not None else None), limit
+
+# Finished rounds of a lobby, newest first. Follow `next` to page further back.
+@app.route('/game/v1/lobby/<int:lobby_id>/rounds', methods=['GET'])
+def get_lobby_rounds(lobby_id):
+    try:
+        before, limit = page_args('before')
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+
+    rounds = finished_rounds(lobby_id, before, limit)
+    return jsonify({
+        'lobby_id': lobby_id,
+        'rounds': [round_json(game_round) for game_round in rounds],
+        'next': rounds[-1].id if len(rounds) == limit else None,
+    })
+
+# Bets of a finished round in id order. Follow `next` to get the rest.
+@app.route('/game/v1/rounds/<int:round_id>/bets', methods=['GET'])
+def get_round_bets(round_id):
+    try:
+        after, limit = page_args('after')
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+
+    game_round = db.session.get(Round, round_id)
+    # Bets of a round in play would give away who is still in
+    if not game_round or game_round.ended_at is None:
+        abort(404)
+
+    bets = round_bets(game_round, after, limit)
+    return jsonify({
+        **round_json(game_round),
+        'bets': [
+            {'bet_id': bet.id, 'user_id': bet.user_id, 'amount': bet.amount, 'coefficient': bet.coefficient,
+             'withdrawal_coefficient': bet.withdrawal_coefficient}
+            for bet in bets
+        ],
+        'next': bets[-1].id if len(bets) == limit else None,
+    })
+
+# Load reported by every game replica
+@app.route('/game/v1/nodes', methods=['GET'])
+def get_nodes():
+    return jsonify(placement.nodes())
+
+# Stop placing lobbies on a replica and move its idle lobbies away (or undo that)
+@app.route('/game/v1/nodes/<node_id>/drain', methods=['PUT'])
+def drain_node(node_id):
+    if request.headers.get('X-Service-Token') != app.config['SERVICE_TOKEN']:
+        return jsonify({"error": "Invalid service token"}), 401
+    draining = bool((request.json or {}).get('draining', True))
+    placement.set_draining(node_id, draining)
+    return jsonify({'node_id': node_id, 'draining': draining})
+
+# Redis ring membership, and (for services) starting a reshard to a new set of nodes
+@app.route('/game/v1/redis/ring', methods=['GET', 'PUT'])
+def redis_ring_membership():
+    if request.method == 'GET':
+        return jsonify(resharder.status())
+
+    if request.headers.get('X-Service-Token') != app.config['SERVICE_TOKEN']:
+        return jsonify({"error": "Invalid service token"}), 401
+    nodes = parse_nodes(','.join((request.json or {}).get('nodes', [])))
+    if not nodes:
+        return jsonify({"error": "nodes must list host:port addresses"}), 400
+    try:
+        version = resharder.propose(nodes)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    if version is None:
+        return jsonify({"error": "A reshard is already in progress"}), 409
+    return jsonify(resharder.status()), 202
+
+# Provably-fair audit: crash points of a lobby's previous (or, for services, next) rounds
+@app.route('/game/v1/lobby/<int:lobby_id>/chain', methods=['GET'])
+def get_lobby_chain(lobby_id):
+    direction = request.args.get('direction', 'previous')
+    try:
+        count = int(request.args.get('count', 100))
+    except ValueError:
+        return jsonify({"error": "count must be an integer"}), 400
+    if direction not in ('previous', 'next') or not 0 < count <= app.config['CHAIN_MAX_COUNT']:
+        return jsonify({"error": f"direction must be previous or next and 0 < count <= {app.config['CHAIN_MAX_COUNT']}"}), 400
+
+    # Upcoming crash points must never reach players
+    if direction == 'next' and request.headers.get('X-Service-Token') != app.config['SERVICE_TOKEN']:
+        return jsonify({"error": "Invalid service token"}), 401
+
+    lobby = db.session.get(Lobby, lobby_id)
+    if not lobby:
+        abort(404)
+    if lobby.chain_length is None:
+        return jsonify({"error": "The lobby starts its hash chain with its next round"}), 409
+
+    # The chain is played backwards, round r is on chain index chain_length - 1 - r
+    chain = chain_for(lobby.initial_hash)
+    played = lobby.round_index
+    if direction == 'previous':
+        # Newest first, each hash is the sha256 preimage of the one after it
+        count = min(count, played)
+        hashes = chain.hashes(lobby.chain_length - played, count)
+        numbers = range(played - 1, played - 1 - count, -1)
+    else:
+        count = min(count, lobby.chain_length - played)
+        hashes = chain.hashes(lobby.chain_length - played - count, count)[::-1]
+        numbers = range(played, played + count)
+    return jsonify({
+        'lobby_id': lobby_id,
+        'commitment': lobby.chain_commitment,
+        'current_round': played,
+        'rounds': [
+            {'round': number, 'hash': h, 'crash_point': point}
+            for number, h, point in zip(numbers, hashes, crash_points(hashes))
+        ],
+    })
+
+@app.route('/game/v1/chain/verify', methods=['POST'])
+def verify_chain():
+    data = request.json or {}
+    seed = data.get('hash')
+    expected = data.get('crash_points')
+    if not seed or not isinstance(expected, list) or len(expected) > app.config['CHAIN_MAX_COUNT']:
+        return jsonify({"error": f"hash and at most {app.config['CHAIN_MAX_COUNT']} crash_points are required"}), 400
+
+    try:
+        mismatches = verify_crash_points(seed, expected)
+    except (TypeError, ValueError):
+        return jsonify({"error": "crash_points must be numbers"}), 400
+    return jsonify({'valid': not mismatches, 'checked': len(expected), 'mismatches': mismatches[:100]})
 
 # Handle WebSocket connections for joining a lobby
 @socketio.on('connect')
 def handle_connect():
+    placement.socket_opened()
     emit('connected', {'message': 'WebSocket connection established'})
 
+@socketio.on('disconnect')
+def handle_disconnect():
+    placement.socket_closed()
+
 @socketio.on('joinRoom')
+@timed_event('joinRoom')
 def handle_join_room(data):
-    lobby_id = data['lobby_id']
-    print(data)
-
-    # Store the room in Redis
-    redis_client = get_redis_client(f"room:{lobby_id}")
-    redis_client.sadd(f"room:{lobby_id}", request.sid)
-    print(redis_client.smembers(f"room:{lobby_id}"))
-    emit(f'Joined room: {lobby_id}', room=request.sid)
+    lobby_id = int(data['lobby_id'])
+    protocol = data.get('protocol', STREAM)
+    if protocol not in PROTOCOLS:
+        protocol = STREAM
+    encoding = data.get('encoding', JSON)
+    if protocol == STREAM or encoding not in available_encodings():
+        encoding = JSON
+
+    # Membership lives in the Socket.IO room, shared across replicas via the message queue
+    join_room(lobby_room(lobby_id, protocol, encoding))
+    emit(f'Joined room: {lobby_id}', {'protocol': protocol, 'encoding': encoding}, room=request.sid)
+
+def emit_curve_frame(event, payload, lobby_id):
+    """ Sends a frame to the lobby's curve-protocol rooms, once per encoding. """
+    for encoding in available_encodings():
+        socketio.emit(event, encode_frame(payload, encoding), room=lobby_room(lobby_id, CURVE, encoding))
 
 def prepare_balance_update(user_id, token, amount):
     """Initiates the prepare phase in the 2PC process with the auth service."""
-    prepare_url = f"{"http://auth_service_1:5000"}/user/v1/balance/prepare"
     try:
-        response = requests.post(prepare_url, json={"user_id": user_id, "amount": -amount}, headers={"Authorization": f"Bearer {token}"})
+        response = auth_client.post("/user/v1/balance/prepare", json={"user_id": user_id, "amount": -amount}, headers={"Authorization": f"Bearer {token}"})
     except Exception as e:
         return False
     if response.status_code == 200:
@@ -153,9 +423,8 @@ def prepare_balance_update(user_id, token, amount):
 
 def commit_balance_update(user_id, token, amount):
     """Commits the balance update in the 2PC process."""
-    commit_url = f"{"http://auth_service_1:5000"}/user/v1/balance/commit"
     try:
-        response = requests.post(commit_url, json={"user_id": user_id, "amount": -amount}, headers={"Authorization": f"Bearer {token}"})
+        response = auth_client.post("/user/v1/balance/commit", json={"user_id": user_id, "amount": -amount}, headers={"Authorization": f"Bearer {token}"})
     except Exception as e:
         return False
     if response.status_code == 200:
@@ -164,9 +433,8 @@ def commit_balance_update(user_id, token, amount):
 
 def abort_balance_update(user_id, token):
     """Aborts the balance update in the 2PC process."""
-    abort_url = f"{"http://auth_service_1:5000"}/user/v1/balance/abort"
     try:
-        response = requests.post(abort_url, json={"user_id": user_id}, headers={"Authorization": f"Bearer {token}"})
+        response = auth_client.post("/user/v1/balance/abort", json={"user_id": user_id}, headers={"Authorization": f"Bearer {token}"})
     except Exception as e:
         return False
     return response.status_code == 200
@@ -175,20 +443,34 @@ def abort_balance_update(user_id, token):
 @app.route('/game/v1/bet', methods=['POST'])
 def place_bet():
     data = request.json
-    user_id = data.get("user_id")
-    lobby_id = data.get("lobby_id")
-    amount = data.get("amount")
-    coefficient = data.get("coefficient")
     try:
-        bet = Bet(user_id=user_id, lobby_id=lobby_id, amount=amount, coefficient=coefficient)
-        db.session.add(bet)
-        db.session.commit()
-        return jsonify({"message": "Created bet"}), 200
-    except Exception as e:
-        db.session.rollback()
-        return jsonify({"error":str(e)}), 400
+        user_id = int(data.get("user_id"))
+        lobby_id = int(data.get("lobby_id"))
+        amount = float(data.get("amount"))
+        coefficient = float(data.get("coefficient"))
+    except (TypeError, ValueError) as e:
+        return jsonify({"error": str(e)}), 400
+
+    lobby = lobby_cache.get(lobby_id)
+    if not lobby:
+        return jsonify({"error": "Lobby does not exist"}), 404
+    if lobby['phase'] != BETTING or lobby['round_id'] is None:
+        # The saga refunds the stake
+        return jsonify({"error": "The game is already in progress"}), 409
+
+    # Acknowledged once the bet is in the lobby's queue, the round start drains it into the database.
+    # The cached phase may be stale, the queue itself refuses bets once the round start closed it
+    try:
+        admitted = bet_queue.enqueue(lobby_id, lobby['round_id'], user_id, amount, coefficient)
+    except redis.exceptions.RedisError as e:
+        app.logger.warning(f"Could not queue a bet for lobby {lobby_id}: {e}")
+        return jsonify({"error": "Bet queue unavailable"}), 503
+    if not admitted:
+        return jsonify({"error": "The game is already in progress"}), 409
+    return jsonify({"message": "Created bet"}), 200
 
 @socketio.on('place_bet')
+@timed_event('place_bet')
 def handle_place_bet(data):
     token = data['token']
     user_info = validate_token(token)
@@ -197,43 +479,51 @@ def handle_place_bet(data):
         return
 
     user_id = user_info['user_id']
-    lobby_id = data['lobby_id']
+    lobby_id = int(data['lobby_id'])
     amount = float(data['amount'])
     coefficient = data['coefficient']
 
-    lobby = db.session.get(Lobby, lobby_id)
+    # Admission is a cache lookup, phase changes are written through by start_game()
+    lobby = lobby_cache.get(lobby_id)
     if not lobby:
         emit('error', {'message': 'Lobby does not exist'})
         return
 
-    if lobby.in_progress:
+    if port is not None and lobby['port'] != int(port):
+        # Rounds run on the replica hosting the lobby
+        emit('lobby_moved', {'lobby_id': lobby_id, 'websocket_url': f"http://localhost:{lobby['port']}"})
+        return
+
+    if lobby['phase'] != BETTING:
         emit('error', {'message': 'Cannot place a bet. The game is already in progress.'})
         return
+
+    # Start the round's countdown before the stake is taken, so a full server rejects the bet
+    # instead of debiting it. No-op if the lobby's round is already scheduled
+    if not scheduler.schedule(lobby_id, run_round(lobby_id)):
+        emit('error', {'message': 'Server is at capacity. Try another lobby.'})
+        return
     
-    response = requests.post(f"{AUTH_SERVICE_URL}/gateway/start_bet_saga", json={"user_id": user_id, "lobby_id":lobby_id, 
-                                                                                 "amount":amount, "coefficient":coefficient}, 
-                                                                                 headers={"Authorization": f"Bearer {token}"})
+    try:
+        response = gateway_client.post("/gateway/start_bet_saga", json={"user_id": user_id, "lobby_id":lobby_id, 
+                                                                        "amount":amount, "coefficient":coefficient}, 
+                                                                        headers={"Authorization": f"Bearer {token}"},
+                                       timeout=(app.config['HTTP_CONNECT_TIMEOUT'], app.config['HTTP_SAGA_TIMEOUT']))
+    except requests.exceptions.RequestException:
+        emit('error', {'message': 'Bet service unavailable, try again'})
+        return
     if response.status_code != 200:
         emit('error', {"statuscode" : str(response.status_code)})
         return
     
-    redis_client = get_redis_client(f"user_token:{user_id}")
-    redis_client.set(f"user_token:{user_id}", token)
-
-    redis_client = get_redis_client(f"user_sid:{request.sid}")
-    redis_client.set(f"user_sid:{request.sid}", user_id)
-
-    # Check if there are any non-withdrawn bets to start the game
-    db.session.commit()
-    active_bets = Bet.query.filter_by(lobby_id=lobby_id, withdrawn=False).all()
-    app.logger.debug(f"This is a debug message {active_bets}")
-    if len(active_bets) == 1:  # Start game logic when there is at least one non-withdrawn bet
-        threading.Thread(target=start_game, args=(lobby_id,)).start()
+    # Bet results are sent to the player's own room
+    join_room(user_room(user_id))
 
     emit('bet_placed', {'user_id': user_id, 'amount': amount, 'coefficient': coefficient})
 
 # Withdraw bet during the game
 @socketio.on('withdraw')
+@timed_event('withdraw')
 def handle_withdraw(data):
     token = data['token']  # Get token from data
     user_info = validate_token(token)  # Validate token
@@ -245,154 +535,358 @@ def handle_withdraw(data):
     lobby_id = data['lobby_id']
     
     # Check if the user has already placed a bet in this lobby
-    bet = Bet.query.filter_by(user_id=user_id, lobby_id=lobby_id, withdrawn=False).first()
-    if bet:
-        # Mark the bet as "requested to withdraw" in Redis
-        redis_client = get_redis_client(f"withdrawals:{user_id}")
-        redis_client.set(f"withdrawals:{user_id}", lobby_id)
+    has_bet = db.session.query(
+        exists().where(Bet.user_id == user_id, Bet.lobby_id == lobby_id, Bet.withdrawn == False)
+    ).scalar()
+    if has_bet:
+        # Queue the withdrawal for the lobby's next tick
+        enqueue_withdrawal(lobby_id, user_id)
         emit('withdraw_requested', {'user_id': user_id, 'message': 'Withdraw requested'})
     else:
         emit('error', {'message': 'No active bet found to withdraw'}, room=request.sid)
 
-def get_all_user_sids():
-    all_user_sids = []
-    
-    for client in redis_clients.values():
-        keys = client.keys('user_sid:*')
-        for key in keys:
-            all_user_sids.append(key.decode('utf-8'))
+def settle_balances(round_id, user_balances, retries=3):
+    """ Credits a whole round's payouts with one call to the auth service.
 
-    return all_user_sids
+    The auth service applies a round at most once, so retrying after a timeout is safe.
+    """
+    entries = [
+        {"user_id": user_id, "delta": delta, "round_id": round_id}
+        for user_id, delta in user_balances.items() if delta
+    ]
+    if not entries:
+        return True
 
-def get_user_ids(lobby_id):
-    redis_client = get_redis_client(f"room:{lobby_id}")
-    
-    user_ids = redis_client.smembers(f"room:{lobby_id}")
-    
-    return [user_id.decode('utf-8') for user_id in user_ids]
+    for attempt in range(retries):
+        try:
+            response = auth_client.post("/user/v1/balance/batch", json={"entries": entries},
+                                        headers={"X-Service-Token": app.config['SERVICE_TOKEN']})
+            if response.status_code == 200:
+                return True
+        except requests.exceptions.RequestException as e:
+            app.logger.warning(f"Settlement of round {round_id} failed (attempt {attempt + 1}): {e}")
 
-def check_withdrawal_exists(user_id):
-    redis_client = get_redis_client(f"withdrawals:{user_id}")
-    
-    exists = redis_client.exists(f"withdrawals:{user_id}")
-    
-    return exists
+    app.logger.error(f"Could not settle round {round_id}")
+    return False
 
-def delete_withdrawal(user_id):
-    redis_client = get_redis_client(f"withdrawals:{user_id}")
-    
-    redis_client.delete(f"withdrawals:{user_id}")
-    
-    print(f"Deleted withdrawals:{user_id} from the appropriate Redis node.")
+def refund_bet(ingest_id, user_id, amount):
+    """ Give back the stake of a queued bet that missed its round, off the calling thread. """
+    socketio.start_background_task(settle_balances, f"refund:{ingest_id}", {user_id: amount})
+
+def withdrawal_queue_key(lobby_id):
+    return f"withdrawals:lobby:{lobby_id}"
+
+def enqueue_withdrawal(lobby_id, user_id):
+    key = withdrawal_queue_key(lobby_id)
+    redis_client = get_redis_client(key)
+    redis_client.rpush(key, user_id)
+
+# Withdrawals popped for lobbies due in the current scheduler pass, not yet applied
+prefetched_withdrawals = {}
+
+def pop_withdrawal_queues(lobby_ids):
+    """ Pop the withdrawal queues of several lobbies, one round trip per Redis node. """
+    # A counted LPOP reads and removes atomically on its own, no MULTI/EXEC needed
+    batch = redis_ring.batch(transaction=False)
+    reads = []
+    for lobby_id in lobby_ids:
+        key = withdrawal_queue_key(lobby_id)
+        # While resharding, the previous owner may still hold part of the queue
+        for node in redis_ring.owners(key):
+            batch.call_on(node, 'lpop', key, app.config['WITHDRAWALS_PER_TICK'])
+            reads.append(lobby_id)
+
+    queues = {lobby_id: [] for lobby_id in lobby_ids}
+    for lobby_id, user_ids in zip(reads, batch.execute()):
+        queues[lobby_id].extend(user_ids or ())
+    return queues
+
+def prefetch_withdrawals(lobby_ids):
+    """ Pop the withdrawal queues of every lobby due to step, ahead of the scheduler pass. """
+    for lobby_id, user_ids in pop_withdrawal_queues(lobby_ids).items():
+        prefetched_withdrawals.setdefault(lobby_id, []).extend(user_ids)
+
+def drain_withdrawals(lobby_id):
+    """ Pop every pending withdrawal for a lobby, prefetched by the scheduler or in a single round trip. """
+    user_ids = prefetched_withdrawals.pop(lobby_id, None)
+    if user_ids is None:
+        user_ids = pop_withdrawal_queues([lobby_id])[lobby_id]
+
+    # A user may click withdraw several times within one tick
+    return list(dict.fromkeys(int(user_id) for user_id in user_ids))
+
+def settle_cashouts(cashed_out, settlement, user_balances):
+    """ Persists one tick's cash-outs in a single batch, then tells each winner. """
+    if not cashed_out:
+        return
 
-def start_game(lobby_id):
-    with app.app_context():
-        time.sleep(10)  # 10s countdown before the game starts
+    results = []
+    for (bet_id, user_id, amount, _), coefficient in cashed_out:
+        payout = amount * coefficient
+        settlement.add(bet_id, coefficient)
+        results.append((user_id, coefficient, payout))
+
+        # Update user's balance with the payout
+        if user_id not in user_balances:
+            user_balances[user_id] = 0
+        user_balances[user_id] += payout
+
+    # One UPDATE for every bet cashed out during this tick
+    with tick_phase('db'):
+        settlement.flush()
+
+    with tick_phase('emit'):
+        for user_id, coefficient, payout in results:
+            socketio.emit('bet_result', {'user_id': user_id, 'result': 'win', 'coefficient': coefficient, 'payout': payout}, room=user_room(user_id))
+
+def run_round(lobby_id):
+    """ start_game(), voiding the lobby's round if it fails part way. """
+    try:
+        yield from start_game(lobby_id)
+    except Exception:
+        abandon_round(lobby_id)
+        raise
+
+def abandon_round(lobby_id):
+    """ Put a lobby whose round failed back into betting.
+
+    A round that had started is voided: bets still open get their stake back, cash-outs
+    already recorded are paid, and the next round is opened. A round that failed during
+    its countdown keeps its bets for the next attempt.
+    """
+    running_lobbies.discard(lobby_id)
+    try:
+        db.session.rollback()
         lobby = db.session.get(Lobby, lobby_id)
         if not lobby:
             return
-        
-        lobby.in_progress = True
+        game_round = db.session.get(Round, lobby.current_round_id)
+        payouts = {}
+        if game_round.started_at is not None and game_round.ended_at is None:
+            round_hash = game_round.hash
+            db.session.execute(
+                update(Bet).where(Bet.round_id == game_round.id, Bet.withdrawn == False)
+                .values(withdrawn=True, withdrawal_coefficient=1.0)
+                .execution_options(synchronize_session=False)
+            )
+            payouts = dict(db.session.execute(
+                select(Bet.user_id, func.sum(Bet.amount * Bet.withdrawal_coefficient))
+                .where(Bet.round_id == game_round.id, Bet.withdrawal_coefficient.is_not(None))
+                .group_by(Bet.user_id)
+            ).all())
+            game_round.ended_at = func.now()
+            advance_chain(lobby)
+            open_round(lobby)
+        lobby.in_progress = False
         db.session.commit()
-        
-        crash_point = crash_point_from_hash(lobby.current_hash)
-        rising_coefficient = 1.00
-
-        # Store user balances to update later
-        user_balances = {}
-        
-        # Emit rising coefficient until the crash point is reached
-        while rising_coefficient <= crash_point:
-            time.sleep(0.05)
-            user_sids = []
-            # Check for withdrawal requests in Redis
-            user_sids = get_all_user_sids()
-            user_ids = get_user_ids(lobby_id)
-            for user_sid in user_sids:
-                redis_client = get_redis_client(user_sid)
-                user_id = redis_client.get(user_sid).decode('utf-8')
-                if check_withdrawal_exists(user_id):
-                    print(user_id, lobby_id)
-                    # Withdraw all bets for this user
-                    bets = Bet.query.filter_by(user_id=user_id, lobby_id=lobby_id, withdrawn=False).all()
-                    for bet in bets:
-                        bet.withdrawn = True
-                        bet.withdrawal_coefficient = rising_coefficient
-                        payout = bet.amount * rising_coefficient
-                        db.session.commit()
-                        socketio.emit('bet_result', {'user_id': user_id, 'result': 'win', 'payout': payout}, room=user_id)
-                        
-                        # Update user's balance with the payout
-                        if user_id not in user_balances:
-                            user_balances[user_id] = 0
-                        user_balances[user_id] += payout
-
-                    # Remove the user from withdrawals once processed
-                    delete_withdrawal(user_id)
-
-            for user in user_ids:
-                socketio.emit('coefficient_update', {'coefficient': rising_coefficient}, room=user)
-
-            rising_coefficient += 0.01
-
-        # After the game is done, mark all bets as withdrawn if they were not already
-        for bet in lobby.bets:
-            if not bet.withdrawn:
-                bet.withdrawn = True
-                if bet.coefficient > crash_point:
-                    if bet.user_id not in user_balances:
-                        user_balances[bet.user_id] = 0 
-                else:
-                    if bet.user_id not in user_balances:
-                        user_balances[bet.user_id] = 0
-                    user_balances[bet.user_id] += bet.amount * bet.coefficient
+        lobby_cache.set(lobby_id, phase=BETTING, round_id=lobby.current_round_id)
+    except (redis.exceptions.RedisError, SQLAlchemyError) as e:
+        db.session.rollback()
+        app.logger.error(f"Could not reset lobby {lobby_id} after a failed round: {e}")
+        return
+
+    if payouts:
+        socketio.start_background_task(settle_balances, f"{lobby_id}:{round_hash}", payouts)
+
+def start_game(lobby_id):
+    """ One crash round for a lobby, stepped by the round scheduler.
+
+    Yields the number of seconds to wait before the next step. Each step runs in a fresh
+    app context (and DB session), so ORM objects are not held across yields.
+    """
+    running_lobbies.discard(lobby_id)
+    yield app.config['ROUND_COUNTDOWN']  # countdown before the game starts
+    with tick_phase('db'):
+        lobby = db.session.get(Lobby, lobby_id)
+        if not lobby:
+            return
+        if port is not None and lobby.port != int(port):
+            # The lobby was moved to another replica before its round started
+            return
 
+        lobby.in_progress = True
+        round_id = lobby.current_round_id
+        game_round = db.session.get(Round, round_id)
+        if lobby.chain_length is None:
+            # Lobbies from before reverse chains: this hash follows from the ones already revealed
+            start_chain(lobby)
+            game_round.hash = lobby.current_hash
+        game_round.started_at = func.now()
+        round_hash = game_round.hash
         db.session.commit()
-        
-        # Update user balances
-        for user_id, balance_change in user_balances.items():
-            # Retrieve the token from Redis for the user
-            redis_client = get_redis_client(f"user_token:{user_id}")
-            token = redis_client.get(f"user_token:{user_id}").decode('utf-8')
-            if token:
-                # Update user balance using the PUT method
-                requests.put(f"{AUTH_SERVICE_URL}/gateway/user/v1/balance", json={"amount": balance_change}, headers={"Authorization": f"Bearer {token}"})
+    running_lobbies.add(lobby_id)
+    with tick_phase('redis'):
+        lobby_cache.set_phase(lobby_id, RUNNING)
 
+    # Close admission, every acknowledged bet must be in the book before the first tick
+    while not drain_bets(lobby_id, round_id):
+        yield app.config['BET_FLUSH_INTERVAL']
+    
+    crash_point = crash_point_from_hash(round_hash)
+    rising_coefficient = 1.00
+
+    # Store user balances to update later
+    user_balances = {}
+    with tick_phase('db'):
+        book = BetBook.load(round_id)
+    settlement = SettlementBuffer()
+
+    # Curve clients get the curve once and draw it locally, with an occasional sync frame
+    tick_interval = app.config['TICK_INTERVAL']
+    sync_every = max(1, round(app.config['CURVE_SYNC_INTERVAL'] / tick_interval))
+    started_at = int((time.time() + tick_interval) * 1000)
+    with tick_phase('emit'):
+        emit_curve_frame('round_start', {'lobby_id': lobby_id, **curve_params(started_at, tick_interval)}, lobby_id)
+    tick = 0
+    
+    # Emit rising coefficient until the crash point is reached
+    while rising_coefficient <= crash_point:
+        yield tick_interval
+        # Auto-cashouts pay at their own target, manual withdrawals at the current coefficient
+        cashed_out = [(bet, bet[3]) for bet in book.cross(rising_coefficient)]
+        with tick_phase('redis'):
+            withdrawals = drain_withdrawals(lobby_id)
+        missing = []
+        for user_id in withdrawals:
+            bets = book.withdraw(user_id)
+            if not bets:
+                missing.append(user_id)
+            cashed_out.extend((bet, rising_coefficient) for bet in bets)
+        if missing:
+            # The bet may have reached the table after the book was loaded
+            with tick_phase('db'):
+                cashed_out.extend((bet, rising_coefficient) for bet in book.late_bets(round_id, missing))
+        settle_cashouts(cashed_out, settlement, user_balances)
+        if missing:
+            paid = {bet[1] for bet, _ in cashed_out}
+            with tick_phase('emit'):
+                for user_id in missing:
+                    if user_id not in paid:
+                        socketio.emit('error', {'message': 'No active bet found to withdraw'}, room=user_room(user_id))
+
+        # One broadcast for the whole lobby
+        with tick_phase('emit'):
+            socketio.emit('coefficient_update', {'coefficient': rising_coefficient}, room=lobby_room(lobby_id))
+            if tick % sync_every == 0:
+                emit_curve_frame('coefficient_sync', {'coefficient': rising_coefficient, 'tick': tick}, lobby_id)
+
+        tick += 1
+        rising_coefficient = round(rising_coefficient + 0.01, 2)
+
+    with tick_phase('redis'):
+        lobby_cache.set_phase(lobby_id, CRASHED)
+    with tick_phase('emit'):
+        socketio.emit('crash', {'crash_point': crash_point}, room=lobby_room(lobby_id))
+        emit_curve_frame('crash', {'crash_point': crash_point, 'tick': tick}, lobby_id)
+
+    # Targets between the last tick and the crash point were still reached
+    settle_cashouts([(bet, bet[3]) for bet in book.cross(crash_point)], settlement, user_balances)
+
+    with tick_phase('db'):
+        # After the game is done, resolve every bet that is still open
+        for user_id, payout in settle_round(round_id, crash_point).items():
+            if user_id not in user_balances:
+                user_balances[user_id] = 0
+            user_balances[user_id] += payout
+
+        game_round = db.session.get(Round, round_id)
+        game_round.crash_point = crash_point
+        game_round.ended_at = func.now()
+        lobby = db.session.get(Lobby, lobby_id)
         lobby.in_progress = False
-        # Update the lobby's hash for the next game
-        lobby.current_hash = generate_hash(lobby.current_hash)
+        # Update the lobby's hash and open the next round
+        advance_chain(lobby)
+        next_round_id = open_round(lobby).id
         db.session.commit()
+    running_lobbies.discard(lobby_id)
+    with tick_phase('redis'):
+        lobby_cache.set(lobby_id, phase=BETTING, round_id=next_round_id)
+
+    # Update user balances for the whole round in one call, off the scheduler thread
+    socketio.start_background_task(settle_balances, f"{lobby_id}:{round_hash}", user_balances)
+
+def migrate_idle_lobbies(limit):
+    """ Move up to `limit` of this replica's idle lobbies to other replicas. Returns how many moved.
+
+    Idle means no round running and no open bet on the lobby's current round. The move is a
+    conditional UPDATE, so a lobby that got a bet in the meantime stays where it is.
+    """
+    own_port = int(port)
+    idle = (Lobby.port == own_port, Lobby.in_progress == False,
+            ~exists().where(Bet.round_id == Lobby.current_round_id, Bet.withdrawn == False))
+    lobby_ids = db.session.scalars(select(Lobby.id).where(*idle).limit(limit)).all()
+
+    moved = 0
+    for lobby_id in lobby_ids:
+        target = place_lobby(lobby_id, exclude=(placement.node_id,))
+        if target is None or int(target) == own_port or scheduler.is_active(lobby_id):
+            continue
+        result = db.session.execute(
+            update(Lobby).where(Lobby.id == lobby_id, *idle).values(port=target)
+            .execution_options(synchronize_session=False)
+        )
+        db.session.commit()
+        if not result.rowcount:
+            continue
+
+        lobby_cache.set(lobby_id, port=target)
+        payload = {'lobby_id': lobby_id, 'websocket_url': f"http://localhost:{target}"}
+        socketio.emit('lobby_moved', payload, room=lobby_room(lobby_id))
+        emit_curve_frame('lobby_moved', payload, lobby_id)
+        moved += 1
+    return moved
+
+def placement_heartbeat():
+    """ Background task: reports this replica's load, and moves idle lobbies away while draining. """
+    while True:
+        try:
+            draining = placement.report(active_rounds=len(scheduler), tick_lag=round(scheduler.lag, 4))
+            if draining:
+                with app.app_context():
+                    moved = migrate_idle_lobbies(app.config['DRAIN_BATCH_SIZE'])
+                    if moved:
+                        app.logger.info(f"Draining: moved {moved} idle lobbies")
+        except (redis.exceptions.RedisError, SQLAlchemyError) as e:
+            app.logger.warning(f"Placement heartbeat failed: {e}")
+        socketio.sleep(app.config['PLACEMENT_HEARTBEAT_INTERVAL'])
+
+def drain_bets(lobby_id, round_id):
+    """ Close the round's bet queue and write what it holds to the database. Returns False if it has to be retried. """
+    try:
+        with tick_phase('redis'):
+            bet_queue.close(lobby_id, round_id)
+        with tick_phase('db'):
+            bet_queue.flush([lobby_id])
+        return True
+    except (redis.exceptions.RedisError, SQLAlchemyError) as e:
+        db.session.rollback()
+        app.logger.warning(f"Draining the bet queue of lobby {lobby_id} failed: {e}")
+        return False
 
-# Hashing Functions
-def salt_hash(hash_value):
-    return hmac.new(hash_value.encode('utf-8'), salt.encode('utf-8'), hashlib.sha256).hexdigest()
-
-def generate_hash(seed):
-    return hashlib.sha256(seed.encode('utf-8')).hexdigest()
-
-# Check if a computed value from the hash is divisible by a given modulus
-def divisible(hash_value, mod):
-    val = 0
-    o = len(hash_value) % 4
-    for i in range(o, len(hash_value), 4):
-        val = ((val << 16) + int(hash_value[i:i + 4], 16)) % mod
-    return val == 0
-
-def crash_point_from_hash(server_seed):
-    hash_value = salt_hash(server_seed)
-    if divisible(hash_value, 20):  # Change modulus for different behavior
-        return 1.0  # Immediate crash
-
-    h = int(hash_value[:13], 16)
-    e = 2**52
-    crash_point = ((100 * e - h) / (e - h)) / 100.0
-    return crash_point
-
-def create_initial_hash():
-    # Generate a random seed
-    random_seed = os.urandom(16).hex()  # Generates a random 16-byte seed in hex
-    initial_hash = generate_hash(random_seed)
-    return initial_hash
+def bet_writer():
+    """ Background task: writes the queued bets of lobbies counting down here, a batch at a time. """
+    while True:
+        with app.app_context():
+            try:
+                # Running rounds drained their queue before the first tick and admit no new bets
+                bet_queue.flush([lobby_id for lobby_id in scheduler.keys() if lobby_id not in running_lobbies])
+            except (redis.exceptions.RedisError, SQLAlchemyError) as e:
+                db.session.rollback()
+                app.logger.warning(f"Writing queued bets failed: {e}")
+        socketio.sleep(app.config['BET_FLUSH_INTERVAL'])
+
+def archive_history():
+    """ Background task: moves finished rounds out of the bet table, a batch at a time. """
+    batch_size = app.config['ARCHIVE_BATCH_SIZE']
+    while True:
+        with app.app_context():
+            try:
+                while archive_rounds(batch_size) == batch_size:
+                    pass
+            except SQLAlchemyError as e:
+                db.session.rollback()
+                app.logger.warning(f"Archiving rounds failed: {e}")
+        socketio.sleep(app.config['ARCHIVE_INTERVAL'])
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(description='Flask Application')
@@ -404,4 +898,11 @@ if __name__ == '__main__':
     service_id = args.serviceIdentifier
     register_service(service_type, service_id)
     port = args.port
+    placement.node_id, placement.port = f"{service_type}_{service_id}", int(port)
+    resharder.refresh()
+    socketio.start_background_task(resharder.watch)
+    socketio.start_background_task(lobby_cache.listen)
+    socketio.start_background_task(placement_heartbeat)
+    socketio.start_background_task(archive_history)
+    socketio.start_background_task(bet_writer)
     socketio.run(app, allow_unsafe_werkzeug=True, host='0.0.0.0', port=5000)
@@ -0,0 +1,7 @@
+import os
+import sys
+
+# Run the game app against in-memory SQLite and no Socket.IO message queue
+os.environ.setdefault("GAME_DATABASE_URI", "sqlite://")
+os.environ.setdefault("GAME_SOCKETIO_MESSAGE_QUEUE", "")
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -0,0 +1,26 @@
+from fairness import crash_point_from_hash, crash_points, divisible, hash_chain, salt_hash
+
+SEED = "0000000000000000000fa3b65e43e4240d71762a5bf397d5304b2596d116859c"
+
+
+def test_divisible(benchmark):
+    hash_value = salt_hash(SEED)
+    benchmark(divisible, hash_value, 20)
+
+
+def test_salt_hash(benchmark):
+    benchmark(salt_hash, SEED)
+
+
+def test_crash_point_from_hash(benchmark):
+    benchmark(crash_point_from_hash, SEED)
+
+
+def test_hash_chain_10k(benchmark):
+    hashes = benchmark(hash_chain, SEED, 10000)
+    assert len(hashes) == 10000
+
+
+def test_crash_points_10k(benchmark):
+    hashes = hash_chain(SEED, 10000)
+    benchmark(crash_points, hashes)
@@ -0,0 +1,79 @@
+import pytest
+
+fakeredis = pytest.importorskip("fakeredis")
+
+import app as game
+from fairness import crash_point_from_hash, generate_hash
+from models import db, Lobby, Bet, Round
+
+LOBBY_ID = 1
+ROUND_ID = 1
+
+
+@pytest.fixture(scope="module")
+def game_app():
+    clients = dict(game.redis_clients)
+    server = fakeredis.FakeServer()
+    for name in clients:
+        game.redis_clients[name] = fakeredis.FakeRedis(server=server)
+
+    with game.app.app_context():
+        db.create_all()
+    yield game.app
+
+    with game.app.app_context():
+        db.drop_all()
+    game.redis_clients.update(clients)
+
+
+def long_round_hash():
+    """ A lobby hash whose round lasts long enough to tick. """
+    seed = "0" * 64
+    while crash_point_from_hash(seed) < 2:
+        seed = generate_hash(seed)
+    return seed
+
+
+@pytest.fixture(params=[(100, 0), (1000, 0), (1000, 100)], ids=lambda p: f"{p[0]}bets-{p[1]}withdrawals")
+def round_setup(request, game_app):
+    bet_count, withdrawal_count = request.param
+    with game_app.app_context():
+        db.session.query(Bet).delete()
+        db.session.query(Round).delete()
+        db.session.query(Lobby).delete()
+        round_hash = long_round_hash()
+        # A one-round chain, so the round is played on its seed
+        db.session.add(Lobby(id=LOBBY_ID, initial_hash=round_hash, current_hash=round_hash, port=5000,
+                             chain_length=1, chain_commitment=generate_hash(round_hash), current_round_id=ROUND_ID))
+        db.session.add(Round(id=ROUND_ID, lobby_id=LOBBY_ID, hash=round_hash))
+        db.session.add_all(
+            Bet(user_id=user_id, lobby_id=LOBBY_ID, round_id=ROUND_ID, amount=10, coefficient=1.5 + user_id % 100)
+            for user_id in range(bet_count)
+        )
+        db.session.commit()
+
+    def setup():
+        with game_app.app_context():
+            db.session.query(Bet).update({'withdrawn': False, 'withdrawal_coefficient': None})
+            db.session.get(Lobby, LOBBY_ID).in_progress = False
+            db.session.commit()
+
+        # Run the countdown and the round start, which loads the bet book
+        round_gen = game.start_game(LOBBY_ID)
+        for _ in range(2):
+            with game_app.app_context():
+                next(round_gen)
+
+        for user_id in range(withdrawal_count):
+            game.enqueue_withdrawal(LOBBY_ID, user_id)
+        return (round_gen,), {}
+
+    return setup
+
+
+def test_start_game_tick(benchmark, game_app, round_setup):
+    def tick(round_gen):
+        with game_app.app_context():
+            next(round_gen)
+
+    benchmark.pedantic(tick, setup=round_setup, rounds=30)
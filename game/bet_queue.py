@@ -0,0 +1,153 @@
+""" Write-behind ingestion of the bets placed through the saga.
+
+`POST /game/v1/bet` appends the bet to its lobby's Redis stream and answers straight
+away. The replica hosting the lobby moves queued bets into the `bet` table in batches,
+one multi-row INSERT and one commit per batch, and drains the lobby's stream before its
+round starts, so the book a round loads always holds every acknowledged bet.
+
+Each entry carries a random `ingest_id` that is stored with the bet under a unique index.
+A batch is deleted from the stream only after its commit, and entries whose id is already
+in the table are skipped, so a writer dying in between (or two writers racing after a
+lobby moved) never inserts a bet twice.
+
+Admission is closed on the stream's own node: the round start sets a marker next to the
+stream, and a Lua script checks it and appends in one step, so no bet gets in after the
+drain. An entry that still reaches the writer after its round stopped being the lobby's
+open one (e.g. through an old owner while resharding) is refunded instead of inserted.
+"""
+import logging
+import threading
+import uuid
+
+from sqlalchemy import insert, select
+from sqlalchemy.exc import IntegrityError
+
+from models import db, Bet, Lobby
+
+logger = logging.getLogger(__name__)
+
+# KEYS: stream, closed marker. ARGV: round id, then the entry's fields and values.
+# Returns 0 without appending once the round (or a later one) is closed
+ENQUEUE = """
+local closed = redis.call('get', KEYS[2])
+if closed and tonumber(closed) >= tonumber(ARGV[1]) then
+    return 0
+end
+redis.call('xadd', KEYS[1], '*', unpack(ARGV, 2))
+return 1
+"""
+
+
+class BetQueue:
+
+    def __init__(self, redis_ring, batch_size=500, refund=None, closed_ttl=86400):
+        self.redis_ring = redis_ring
+        self.batch_size = batch_size  # entries read per lobby per pass
+        self.closed_ttl = closed_ttl
+        # Called with (ingest_id, user_id, amount) for every queued bet that missed its round
+        self._refund = refund
+        # One writer per process, the background writer and a round start may drain the same lobby
+        self._lock = threading.Lock()
+        # Run on the stream's owner, the client it is registered with is never used
+        self._enqueue = redis_ring.clients[redis_ring.directory].register_script(ENQUEUE)
+
+    @staticmethod
+    def key(lobby_id):
+        return f"bets:lobby:{lobby_id}"
+
+    @staticmethod
+    def closed_key(lobby_id):
+        # Tagged with the stream's name, so it always lives on the stream's node
+        return f"{{bets:lobby:{lobby_id}}}:closed"
+
+    def enqueue(self, lobby_id, round_id, user_id, amount, coefficient):
+        """ Append a bet on `round_id` to the lobby's stream. Returns its ingest id, or None once the round is closed. """
+        ingest_id = uuid.uuid4().hex
+        fields = {'ingest_id': ingest_id, 'user_id': user_id, 'amount': amount, 'coefficient': coefficient,
+                  'round_id': round_id}
+        key = self.key(lobby_id)
+        args = [round_id, *(item for pair in fields.items() for item in pair)]
+        if not self._enqueue(keys=[key, self.closed_key(lobby_id)], args=args, client=self.redis_ring.client_for(key)):
+            return None
+        return ingest_id
+
+    def close(self, lobby_id, round_id):
+        """ Stop admitting bets on `round_id` (and earlier rounds) of the lobby. """
+        key = self.closed_key(lobby_id)
+        self.redis_ring.client_for(key).set(key, round_id, ex=self.closed_ttl)
+
+    def flush(self, lobby_ids):
+        """ Write every queued bet of the lobbies to the database. Returns how many were inserted. """
+        lobby_ids = list(lobby_ids)
+        written = conflicts = 0
+        with self._lock:
+            while lobby_ids:
+                try:
+                    inserted, lobby_ids = self._flush_batch(lobby_ids)
+                except IntegrityError:
+                    # Another writer got some of them first, the next pass skips those
+                    db.session.rollback()
+                    conflicts += 1
+                    if conflicts > 3:
+                        raise
+                    continue
+                written += inserted
+        return written
+
+    def _flush_batch(self, lobby_ids):
+        """ Move one batch per lobby. Returns (bets inserted, lobbies that may have more). """
+        # While resharding, part of a stream may still be on its previous owner
+        batch = self.redis_ring.batch(transaction=False)
+        reads = []
+        for lobby_id in lobby_ids:
+            key = self.key(lobby_id)
+            for node in self.redis_ring.owners(key):
+                batch.call_on(node, 'xrange', key, '-', '+', count=self.batch_size)
+                reads.append((lobby_id, node, key))
+
+        queued = []  # (lobby_id, node, key, entry id, fields)
+        more = set()
+        for (lobby_id, node, key), entries in zip(reads, batch.execute()):
+            if len(entries) == self.batch_size:
+                more.add(lobby_id)
+            queued.extend((lobby_id, node, key, entry_id, fields) for entry_id, fields in entries)
+        if not queued:
+            return 0, []
+
+        rounds = dict(db.session.execute(
+            select(Lobby.id, Lobby.current_round_id).where(Lobby.id.in_({entry[0] for entry in queued}))
+        ).all())
+        ingest_ids = [fields[b'ingest_id'].decode('utf-8') for *_, fields in queued]
+        existing = set(db.session.scalars(select(Bet.ingest_id).where(Bet.ingest_id.in_(ingest_ids))))
+
+        rows = []
+        refunds = []
+        for (lobby_id, *_, fields), ingest_id in zip(queued, ingest_ids):
+            if ingest_id in existing:
+                continue
+            round_id = int(fields[b'round_id']) if b'round_id' in fields else rounds.get(lobby_id)
+            if round_id is None or round_id != rounds.get(lobby_id):
+                # The round was drained and played without it
+                logger.warning(f"Refunding queued bet {ingest_id}, round {round_id} of lobby {lobby_id} is not open")
+                refunds.append((ingest_id, int(fields[b'user_id']), float(fields[b'amount'])))
+                continue
+            rows.append({'ingest_id': ingest_id, 'user_id': int(fields[b'user_id']), 'lobby_id': lobby_id,
+                         'round_id': round_id, 'amount': float(fields[b'amount']),
+                         'coefficient': float(fields[b'coefficient'])})
+        if rows:
+            db.session.execute(insert(Bet), rows)
+            db.session.commit()
+        # Refunds are idempotent per ingest id, an entry refunded twice is only paid once
+        if self._refund:
+            for refund in refunds:
+                self._refund(*refund)
+
+        # Only committed (or already present) entries leave the stream
+        batch = self.redis_ring.batch(transaction=False)
+        by_stream = {}
+        for _, node, key, entry_id, _ in queued:
+            by_stream.setdefault((node, key), []).append(entry_id)
+        for (node, key), entry_ids in by_stream.items():
+            batch.call_on(node, 'xdel', key, *entry_ids)
+        batch.execute()
+        return len(rows), [lobby_id for lobby_id in lobby_ids if lobby_id in more]
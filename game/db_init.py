@@ -1,4 +1,6 @@
 from app import app, db
+from flask_migrate import stamp, upgrade
+from sqlalchemy import inspect
 import MySQLdb
 
 # Function to create the database if it doesn't exist
@@ -9,12 +11,26 @@ def create_database_if_not_exists():
     # c.execute("DROP DATABASE IF EXISTS game_db")
     c.execute(f"CREATE DATABASE IF NOT EXISTS game_db")
 
-    db.close()
+    return db
+
+def migrate_database():
+    tables = inspect(db.engine).get_table_names()
+    if 'lobby' in tables and 'alembic_version' not in tables:
+        # Database created by db.create_all() before migrations existed
+        stamp(revision='0001')
+    upgrade()
 
 with app.app_context():
     try:
-        create_database_if_not_exists()
-        db.create_all()  # Create tables if they don't exist
+        conn = create_database_if_not_exists()
+        # Game replicas start together, only one of them may run the migrations
+        c = conn.cursor()
+        c.execute("SELECT GET_LOCK('game_db_migrate', 120)")
+        try:
+            migrate_database()
+        finally:
+            c.execute("SELECT RELEASE_LOCK('game_db_migrate')")
+            conn.close()
         print("Database initialized")
     except Exception as e:
-        print(f"Error initializing database: {e}")
\ No newline at end of file
+        print(f"Error initializing database: {e}")
@@ -0,0 +1,136 @@
+import heapq
+import itertools
+import logging
+import threading
+import time
+from contextlib import nullcontext
+
+import game_metrics
+
+logger = logging.getLogger(__name__)
+
+
+class RoundScheduler:
+    """ Drives every active round in the process from a single thread.
+
+    A round is a generator that yields how many seconds it wants to sleep before its next
+    step. Wake-ups are kept in a heap ordered by monotonic deadline, and each deadline is
+    advanced from the previous one rather than from "now" so ticks do not drift.
+
+    `prepare`, if given, is called with the keys of every round due in a pass before any of
+    them steps, so per-round I/O can be fetched for all of them in one batch.
+    """
+
+    def __init__(self, max_rounds=1000, context=None, start_background_task=None, prepare=None):
+        self.max_rounds = max_rounds
+        self._context = context or nullcontext
+        self._start_background_task = start_background_task
+        self._prepare = prepare
+        self._heap = []
+        self._rounds = {}
+        self._counter = itertools.count()
+        self._wakeup = threading.Condition()
+        self._started = False
+        self.lag = 0.0  # seconds the latest pass started behind its earliest deadline
+
+    def __len__(self):
+        return len(self._rounds)
+
+    def is_active(self, key):
+        return key in self._rounds
+
+    def keys(self):
+        with self._wakeup:
+            return list(self._rounds)
+
+    def at_capacity(self):
+        return len(self._rounds) >= self.max_rounds
+
+    def schedule(self, key, round_gen):
+        """ Start driving `round_gen` under `key`. Returns False when the process is full.
+
+        Scheduling a key that already has a running round is a no-op.
+        """
+        with self._wakeup:
+            if key in self._rounds:
+                round_gen.close()
+                return True
+            if len(self._rounds) >= self.max_rounds:
+                round_gen.close()
+                return False
+
+            self._rounds[key] = round_gen
+            heapq.heappush(self._heap, (time.monotonic(), next(self._counter), key))
+            self._ensure_started()
+            self._wakeup.notify()
+        return True
+
+    def _ensure_started(self):
+        if self._started:
+            return
+        self._started = True
+        if self._start_background_task:
+            self._start_background_task(self.run)
+        else:
+            threading.Thread(target=self.run, daemon=True).start()
+
+    def _next_due(self):
+        """ Block until the earliest deadline has passed, then pop every due round. """
+        with self._wakeup:
+            while True:
+                if not self._heap:
+                    self.lag = 0.0
+                    self._wakeup.wait()
+                    continue
+                now = time.monotonic()
+                timeout = self._heap[0][0] - now
+                if timeout > 0:
+                    self.lag = 0.0
+                    self._wakeup.wait(timeout)
+                    continue
+                self.lag = -timeout
+                due = []
+                while self._heap and self._heap[0][0] <= now:
+                    deadline, _, key = heapq.heappop(self._heap)
+                    due.append((deadline, key, self._rounds[key]))
+                return due
+
+    def run(self):
+        game_metrics.mark_scheduler_thread()
+        while True:
+            due = self._next_due()
+            if self._prepare:
+                try:
+                    with self._context(), game_metrics.PREPARE_SECONDS.time():
+                        self._prepare([key for _, key, _ in due])
+                except Exception:
+                    logger.exception("Preparing rounds failed")
+
+            for deadline, key, round_gen in due:
+                self._step(deadline, key, round_gen)
+
+    def _step(self, deadline, key, round_gen):
+        start = time.monotonic()
+        game_metrics.begin_tick()
+        try:
+            with self._context():
+                delay = next(round_gen)
+        except StopIteration:
+            delay = None
+        except Exception:
+            logger.exception(f"Round {key} failed")
+            delay = None
+        finally:
+            game_metrics.end_tick(time.monotonic() - start, start - deadline)
+
+        with self._wakeup:
+            if delay is None:
+                del self._rounds[key]
+                return
+
+            next_deadline = deadline + delay
+            now = time.monotonic()
+            if next_deadline < now - delay:
+                # Fell more than a whole step behind, skip ahead instead of bursting
+                next_deadline = now
+            heapq.heappush(self._heap, (next_deadline, next(self._counter), key))
@@ -0,0 +1,147 @@
+""" Provably-fair hash chain.
+
+A lobby draws a random secret `seed` and a chain length N, and hashes forward:
+h(0) = seed, h(n) = sha256(h(n - 1)). The chain is played backwards: round r is played
+on h(N - 1 - r), and its crash point is derived from HMAC-SHA256(h(N - 1 - r), salt).
+h(N) is published before the first round as the chain's commitment.
+
+A revealed round hash therefore hashes to the round before it (and the first round's to
+the commitment), so players can check every past round, while the next round's hash is
+a preimage of the last revealed one and cannot be computed from it. When a chain runs
+out, the lobby starts a new one.
+
+Run as a script to replay played rounds offline, newest first:
+
+    python fairness.py --hash <hash of the newest round> --count 1000000 --workers 8
+"""
+from concurrent.futures import ProcessPoolExecutor
+from functools import lru_cache
+import argparse
+import hashlib
+import hmac
+import os
+import threading
+
+salt = "0000000000000000000fa3b65e43e4240d71762a5bf397d5304b2596d116859c"
+
+# Batches longer than this are scored across a process pool when workers are requested
+PARALLEL_THRESHOLD = 50000
+# Every Nth hash is kept so any round can be reached without walking from the start
+CHECKPOINT_EVERY = 1024
+
+# Hashing Functions
+def salt_hash(hash_value):
+    return hmac.new(hash_value.encode('utf-8'), salt.encode('utf-8'), hashlib.sha256).hexdigest()
+
+def generate_hash(seed):
+    return hashlib.sha256(seed.encode('utf-8')).hexdigest()
+
+# Check if a computed value from the hash is divisible by a given modulus
+def divisible(hash_value, mod):
+    val = 0
+    o = len(hash_value) % 4
+    for i in range(o, len(hash_value), 4):
+        val = ((val << 16) + int(hash_value[i:i + 4], 16)) % mod
+    return val == 0
+
+def crash_point_from_hash(server_seed):
+    hash_value = salt_hash(server_seed)
+    if divisible(hash_value, 20):  # Change modulus for different behavior
+        return 1.0  # Immediate crash
+
+    h = int(hash_value[:13], 16)
+    e = 2**52
+    crash_point = ((100 * e - h) / (e - h)) / 100.0
+    return crash_point
+
+def create_initial_hash():
+    # Generate a random seed
+    random_seed = os.urandom(16).hex()  # Generates a random 16-byte seed in hex
+    initial_hash = generate_hash(random_seed)
+    return initial_hash
+
+# Batch Functions
+def hash_chain(seed, count):
+    """ The `count` hashes starting at `seed` itself: [seed, sha256(seed), ...]. """
+    hashes = []
+    sha256 = hashlib.sha256
+    for _ in range(count):
+        hashes.append(seed)
+        seed = sha256(seed.encode('utf-8')).hexdigest()
+    return hashes
+
+def _crash_points_serial(hashes):
+    return [crash_point_from_hash(h) for h in hashes]
+
+def crash_points(hashes, workers=None):
+    """ Crash points for a batch of round hashes, in order.
+
+    The chain itself is sequential, but scoring each hash is independent, so with
+    `workers` set long batches are split into chunks and scored in a process pool. The
+    web endpoints stay serial: spawning workers from the server would re-import the app.
+    """
+    if not workers or len(hashes) < PARALLEL_THRESHOLD:
+        return _crash_points_serial(hashes)
+
+    chunk = -(-len(hashes) // (4 * workers))
+    chunks = [hashes[i:i + chunk] for i in range(0, len(hashes), chunk)]
+    points = []
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        for part in pool.map(_crash_points_serial, chunks):
+            points.extend(part)
+    return points
+
+def verify_crash_points(seed, expected, workers=None):
+    """ Replays the chain from `seed` and returns the indexes whose crash point differs
+    from `expected` (compared to the cent, as shown to players). """
+    actual = crash_points(hash_chain(seed, len(expected)), workers)
+    return [i for i, (a, b) in enumerate(zip(actual, expected)) if round(a, 2) != round(float(b), 2)]
+
+
+class HashChain:
+    """ One lobby's chain, walked forward from its seed and shared between requests.
+
+    Only every CHECKPOINT_EVERY-th hash is kept, so memory stays small for long chains
+    while any round is at most one checkpoint walk away.
+    """
+
+    def __init__(self, seed):
+        self.seed = seed
+        self._checkpoints = [seed]
+        self._lock = threading.Lock()
+
+    def hash_at(self, index):
+        with self._lock:
+            checkpoint = min(index // CHECKPOINT_EVERY, len(self._checkpoints) - 1)
+            seed = self._checkpoints[checkpoint]
+            for i in range(checkpoint * CHECKPOINT_EVERY, index):
+                seed = generate_hash(seed)
+                if (i + 1) % CHECKPOINT_EVERY == 0 and (i + 1) // CHECKPOINT_EVERY == len(self._checkpoints):
+                    self._checkpoints.append(seed)
+            return seed
+
+    def hashes(self, start, count):
+        return hash_chain(self.hash_at(start), count)
+
+# Roughly 1 KB per 1000 rounds of chain, sized for every lobby a process may be running
+@lru_cache(maxsize=4096)
+def chain_for(seed):
+    return HashChain(seed)
+
+def new_chain(length):
+    """ (seed, commitment) of a fresh chain of `length` rounds. """
+    seed = create_initial_hash()
+    # Walking to the commitment also lays down the checkpoints its rounds are read from
+    return seed, chain_for(seed).hash_at(length)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Replay a provably-fair hash chain')
+    parser.add_argument('--hash', required=True, help='Hash of the newest round to replay')
+    parser.add_argument('--count', type=int, default=100, help='Number of rounds, going back in time')
+    parser.add_argument('--workers', type=int, default=os.cpu_count(), help='Processes used for long chains')
+    args = parser.parse_args()
+
+    hashes = hash_chain(args.hash, args.count)
+    for i, (h, point) in enumerate(zip(hashes, crash_points(hashes, args.workers))):
+        print(f"{i},{h},{point:.2f}")
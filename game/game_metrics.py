@@ -0,0 +1,105 @@
+""" Prometheus metrics for the game loop and the socket handlers.
+
+Everything here lands in the default registry, so it is exported on /metrics next to the
+HTTP route metrics. Round steps run on the scheduler thread: while a step runs, time spent
+in `tick_phase` blocks is added up and observed per phase when the step ends. Redis round
+trips and DB commits are counted by where they came from, `scheduler` or `handler`, so
+per-tick figures are e.g. rate(game_redis_round_trips_total{source="scheduler"}[1m]) /
+rate(game_tick_seconds_count[1m]).
+"""
+from contextlib import contextmanager
+from functools import wraps
+import threading
+import time
+
+from prometheus_client import Counter, Gauge, Histogram
+from sqlalchemy import event
+from sqlalchemy.orm import Session
+
+# Ticks are 50 ms apart by default, the interesting range is around and below that
+TICK_BUCKETS = (.0005, .001, .0025, .005, .01, .025, .05, .075, .1, .25, .5, 1.0, 2.5)
+
+TICK_SECONDS = Histogram('game_tick_seconds', 'Time spent in one round step', buckets=TICK_BUCKETS)
+TICK_LATENESS = Histogram('game_tick_lateness_seconds', 'How late a round step started against its schedule',
+                          buckets=TICK_BUCKETS)
+TICK_PHASE_SECONDS = Histogram('game_tick_phase_seconds', 'Time one round step spent in each phase', ['phase'],
+                               buckets=TICK_BUCKETS)
+PREPARE_SECONDS = Histogram('game_scheduler_prepare_seconds', 'Batched prefetch before a scheduler pass',
+                            buckets=TICK_BUCKETS)
+REDIS_ROUND_TRIPS = Counter('game_redis_round_trips', 'Commands or pipelines sent to Redis', ['source'])
+DB_COMMITS = Counter('game_db_commits', 'Database transactions committed', ['source'])
+SOCKET_EVENT_SECONDS = Histogram('game_socket_event_seconds', 'Time spent in a socket event handler', ['event'])
+ACTIVE_LOBBIES = Gauge('game_active_lobbies', 'Lobbies with a round scheduled on this replica')
+ACTIVE_ROUNDS = Gauge('game_active_rounds', 'Rounds past their countdown on this replica')
+SOCKETS = Gauge('game_sockets', 'Connected sockets on this replica')
+
+PHASES = ('redis', 'db', 'emit')
+
+_local = threading.local()
+
+
+def mark_scheduler_thread():
+    _local.source = 'scheduler'
+
+
+def current_source():
+    return getattr(_local, 'source', 'handler')
+
+
+@contextmanager
+def acting_for(source):
+    """ Count the block's Redis and DB work for `source`, e.g. in a worker thread. """
+    previous, _local.source = current_source(), source
+    try:
+        yield
+    finally:
+        _local.source = previous
+
+
+def begin_tick():
+    _local.phases = dict.fromkeys(PHASES, 0.0)
+
+
+def end_tick(duration, lateness):
+    phases, _local.phases = _local.phases, None
+    TICK_SECONDS.observe(duration)
+    TICK_LATENESS.observe(lateness)
+    for phase, spent in phases.items():
+        TICK_PHASE_SECONDS.labels(phase).observe(spent)
+
+
+@contextmanager
+def tick_phase(phase):
+    """ Add the time spent in the block to `phase` of the running step, if any. """
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        phases = getattr(_local, 'phases', None)
+        if phases is not None:
+            phases[phase] += time.perf_counter() - start
+
+
+def redis_round_trip():
+    REDIS_ROUND_TRIPS.labels(current_source()).inc()
+
+
+@event.listens_for(Session, 'after_commit')
+def _count_commit(session):
+    DB_COMMITS.labels(current_source()).inc()
+
+
+def timed_event(name):
+    """ Decorator recording how long a socket event handler takes. """
+    def decorator(handler):
+        observe = SOCKET_EVENT_SECONDS.labels(name)
+
+        @wraps(handler)
+        def wrapper(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return handler(*args, **kwargs)
+            finally:
+                observe.observe(time.perf_counter() - start)
+        return wrapper
+    return decorator
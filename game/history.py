@@ -0,0 +1,57 @@
+from sqlalchemy import delete, insert, select, update
+from models import db, Bet, BetHistory, Round
+
+# Columns copied from bet to bet_history, in the same order on both sides
+ARCHIVED_COLUMNS = ('id', 'user_id', 'lobby_id', 'round_id', 'amount', 'coefficient', 'withdrawn',
+                    'withdrawal_coefficient')
+
+
+def archive_rounds(batch_size):
+    """ Move the bets of up to `batch_size` finished rounds to bet_history, in one transaction.
+
+    Rounds are claimed with SKIP LOCKED so several game replicas can archive side by side.
+    Returns the number of rounds archived.
+    """
+    round_ids = db.session.scalars(
+        select(Round.id)
+        .where(Round.archived == False, Round.ended_at.is_not(None))
+        .order_by(Round.id)
+        .limit(batch_size)
+        .with_for_update(skip_locked=True)
+    ).all()
+    if not round_ids:
+        db.session.commit()
+        return 0
+
+    db.session.execute(
+        insert(BetHistory).from_select(
+            ARCHIVED_COLUMNS,
+            select(*(getattr(Bet, column) for column in ARCHIVED_COLUMNS)).where(Bet.round_id.in_(round_ids)),
+        )
+    )
+    db.session.execute(delete(Bet).where(Bet.round_id.in_(round_ids)).execution_options(synchronize_session=False))
+    db.session.execute(update(Round).where(Round.id.in_(round_ids)).values(archived=True)
+                       .execution_options(synchronize_session=False))
+    db.session.commit()
+    return len(round_ids)
+
+
+def finished_rounds(lobby_id, before=None, limit=50):
+    """ A page of the lobby's finished rounds, newest first.
+
+    Keyset pagination: pass the last id of a page as `before` to get the next one, so a
+    page costs the same however deep into the history it is.
+    """
+    query = select(Round).where(Round.lobby_id == lobby_id, Round.ended_at.is_not(None))
+    if before is not None:
+        query = query.where(Round.id < before)
+    return db.session.scalars(query.order_by(Round.id.desc()).limit(limit)).all()
+
+
+def round_bets(game_round, after=None, limit=100):
+    """ A page of a finished round's bets in id order, from bet_history once archived. """
+    model = BetHistory if game_round.archived else Bet
+    query = select(model).where(model.round_id == game_round.id)
+    if after is not None:
+        query = query.where(model.id > after)
+    return db.session.scalars(query.order_by(model.id).limit(limit)).all()
@@ -0,0 +1,102 @@
+import time
+
+import requests
+from prometheus_client import Histogram, REGISTRY
+from prometheus_client.core import CounterMetricFamily, GaugeMetricFamily
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+OUTBOUND_LATENCY = Histogram(
+    'game_outbound_request_seconds',
+    'Latency of calls from the game service to other services',
+    ['service', 'method', 'status'],
+)
+
+
+class ServiceClient:
+    """ Keep-alive HTTP client for one upstream service.
+
+    Every call reuses connections from a per-host pool and gets default timeouts, so a
+    call costs the remote work rather than a TCP handshake, and a stuck upstream cannot
+    hold a worker forever. Only connection errors are retried: the request never left.
+    """
+
+    def __init__(self, name, base_url, pool_size=50, connect_timeout=1.0, read_timeout=5.0, connect_retries=2):
+        self.name = name
+        self.base_url = base_url.rstrip('/')
+        self.timeout = (connect_timeout, read_timeout)
+
+        self._adapter = HTTPAdapter(
+            pool_connections=4,
+            pool_maxsize=pool_size,
+            max_retries=Retry(total=connect_retries, connect=connect_retries, read=0, status=0, other=0,
+                              backoff_factor=0.05, raise_on_status=False),
+        )
+        self.session = requests.Session()
+        self.session.mount('http://', self._adapter)
+        self.session.mount('https://', self._adapter)
+
+    def request(self, method, path, **kwargs):
+        kwargs.setdefault('timeout', self.timeout)
+        status = 'error'
+        start = time.perf_counter()
+        try:
+            response = self.session.request(method, f"{self.base_url}{path}", **kwargs)
+            status = str(response.status_code)
+            return response
+        finally:
+            OUTBOUND_LATENCY.labels(self.name, method, status).observe(time.perf_counter() - start)
+
+    def get(self, path, **kwargs):
+        return self.request('GET', path, **kwargs)
+
+    def post(self, path, **kwargs):
+        return self.request('POST', path, **kwargs)
+
+    def put(self, path, **kwargs):
+        return self.request('PUT', path, **kwargs)
+
+    def pool_stats(self):
+        """ (host, open connections, idle connections, requests sent) per pooled host. """
+        pools = self._adapter.poolmanager.pools
+        with pools.lock:
+            host_pools = list(pools._container.values())
+        # The pool's queue is pre-filled with None placeholders, only real entries are idle connections
+        return [
+            (pool.host, pool.num_connections, sum(conn is not None for conn in list(pool.pool.queue)) if pool.pool else 0,
+             pool.num_requests)
+            for pool in host_pools
+        ]
+
+
+class PoolCollector:
+    """ Exposes the connection pools of registered clients on /metrics. """
+
+    def __init__(self):
+        self.clients = []
+
+    def collect(self):
+        opened = CounterMetricFamily('game_http_pool_connections_opened', 'Connections opened by the pool',
+                                     labels=['service', 'host'])
+        idle = GaugeMetricFamily('game_http_pool_idle_connections', 'Idle keep-alive connections in the pool',
+                                 labels=['service', 'host'])
+        sent = CounterMetricFamily('game_http_pool_requests', 'Requests sent through the pool',
+                                   labels=['service', 'host'])
+        for client in self.clients:
+            for host, num_connections, num_idle, num_requests in client.pool_stats():
+                opened.add_metric([client.name, host], num_connections)
+                idle.add_metric([client.name, host], num_idle)
+                sent.add_metric([client.name, host], num_requests)
+        yield opened
+        yield idle
+        yield sent
+
+
+pool_collector = PoolCollector()
+REGISTRY.register(pool_collector)
+
+
+def service_client(name, base_url, **kwargs):
+    client = ServiceClient(name, base_url, **kwargs)
+    pool_collector.clients.append(client)
+    return client
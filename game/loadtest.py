@@ -0,0 +1,296 @@
+""" Socket.IO load generator and latency harness for the crash game.
+
+Simulates players spread over lobbies. Each player joins its lobby room, bets between
+rounds and sometimes cashes out by hand. At the end it reports bet-ack latency, manual
+cash-out to `bet_result` latency, tick jitter and received messages per second.
+
+Against a running game service (tokens are signed with the shared JWT key, the users
+must exist and have a balance):
+
+    python loadtest.py --url http://localhost:5001 --clients 500 --lobbies 20 --duration 60
+
+Or the whole stack in this process, on SQLite + fakeredis behind a stub gateway/auth:
+
+    python loadtest.py --local --clients 1000 --lobbies 50 --duration 60
+"""
+from datetime import datetime, timedelta, timezone
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlparse
+import argparse
+import os
+import random
+import sys
+import tempfile
+import threading
+import time
+
+import jwt
+import requests
+import socketio
+
+
+class Stats:
+    """ Samples shared by every simulated player. """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        """ Start measuring afresh, e.g. once every player has connected. """
+        with self._lock:
+            self.bet_ack = []  # seconds from place_bet to bet_placed
+            self.cashout = []  # seconds from withdraw to bet_result
+            self.tick_jitter = []  # seconds between coefficient_update frames, minus the tick interval
+            self.rejected = 0
+            self.errors = 0
+            self.messages = 0
+
+    def message(self):
+        with self._lock:
+            self.messages += 1
+
+    def reject(self):
+        with self._lock:
+            self.rejected += 1
+
+    def error(self):
+        with self._lock:
+            self.errors += 1
+
+
+class Player:
+    """ One socket client, betting in a single lobby until stopped. """
+
+    def __init__(self, url, user_id, lobby_id, token, stats, tick_interval, observer=False, withdraw_ratio=0.5,
+                 think_time=1.0):
+        self.url = url
+        self.user_id = user_id
+        self.lobby_id = lobby_id
+        self.token = token
+        self.stats = stats
+        self.tick_interval = tick_interval
+        self.observer = observer  # one player per lobby measures tick jitter
+        self.withdraw_ratio = withdraw_ratio
+        self.think_time = think_time
+        self.rng = random.Random(user_id)
+        self.running = True
+
+        self.bet_sent = None
+        self.cashout_at = None
+        self.withdraw_sent = None
+        self.last_tick = None
+
+        self.sio = socketio.Client(reconnection=False)
+        self.sio.on('*', self.on_event)
+
+    def connect(self):
+        self.sio.connect(self.url, transports=['websocket'])
+        self.sio.emit('joinRoom', {'lobby_id': self.lobby_id})
+
+    def close(self):
+        self.running = False
+        self.sio.disconnect()
+
+    def place_bet(self):
+        if not self.running or self.bet_sent:
+            return
+        self.cashout_at = round(self.rng.uniform(1.05, 3.0), 2) if self.rng.random() < self.withdraw_ratio else None
+        self.bet_sent = time.perf_counter()
+        self.sio.emit('place_bet', {'token': self.token, 'lobby_id': self.lobby_id, 'amount': 1,
+                                    'coefficient': round(self.rng.uniform(1.1, 10.0), 2)})
+
+    def bet_later(self):
+        def bet():
+            self.sio.sleep(self.rng.uniform(0, self.think_time))
+            self.place_bet()
+        self.sio.start_background_task(bet)
+
+    def on_event(self, event, data=None):
+        self.stats.message()
+        now = time.perf_counter()
+
+        if event == f'Joined room: {self.lobby_id}':
+            self.bet_later()
+        elif event == 'bet_placed':
+            if self.bet_sent:
+                self.stats.bet_ack.append(now - self.bet_sent)
+        elif event == 'error':
+            if self.bet_sent:
+                # Usually "game in progress", bet again after the crash
+                self.stats.reject()
+                self.bet_sent = None
+            else:
+                self.stats.error()
+        elif event == 'coefficient_update':
+            if self.observer and self.last_tick is not None:
+                self.stats.tick_jitter.append(abs(now - self.last_tick - self.tick_interval))
+            self.last_tick = now
+            if self.cashout_at and not self.withdraw_sent and data['coefficient'] >= self.cashout_at:
+                self.withdraw_sent = now
+                self.sio.emit('withdraw', {'token': self.token, 'lobby_id': self.lobby_id})
+        elif event == 'bet_result':
+            if self.withdraw_sent:
+                self.stats.cashout.append(now - self.withdraw_sent)
+        elif event == 'crash':
+            self.bet_sent = self.withdraw_sent = self.cashout_at = self.last_tick = None
+            self.bet_later()
+
+
+def make_token(user_id, key, algorithm):
+    """ A token the game service accepts, signed like the auth service signs them. """
+    now = datetime.now(timezone.utc)
+    return jwt.encode({'sub': user_id, 'iat': now, 'exp': now + timedelta(hours=1)}, key, algorithm=algorithm)
+
+
+def create_lobbies(url, count, token):
+    lobbies = []
+    for _ in range(count):
+        response = requests.post(f"{url}/game/v1/lobby", json={}, headers={'Authorization': f"Bearer {token}"},
+                                 timeout=10)
+        response.raise_for_status()
+        lobbies.append(response.json()['lobby_id'])
+    return lobbies
+
+
+def lobby_url(url, lobby_id):
+    """ Socket URL of the replica hosting the lobby, on the same host as `url`. """
+    response = requests.get(f"{url}/game/v1/lobby/{lobby_id}", timeout=10)
+    response.raise_for_status()
+    port = urlparse(response.json()['websocket_url']).port
+    base = urlparse(url)
+    return f"{base.scheme}://{base.hostname}:{port or base.port}"
+
+
+def start_local_stack(port, stub_port, countdown):
+    """ Run the game service in this process on SQLite + fakeredis, with a stub gateway/auth.
+
+    The stub saga skips balances and places the bet straight away, settlements are
+    acknowledged and dropped. Must run before config is imported. Returns the game app module.
+    """
+    db_path = os.path.join(tempfile.mkdtemp(prefix='crash-loadtest-'), 'game.db')
+    os.environ['GAME_DATABASE_URI'] = f"sqlite:///{db_path}?timeout=30"
+    os.environ['GAME_SOCKETIO_MESSAGE_QUEUE'] = ''
+    os.environ['GAME_GATEWAY_URL'] = os.environ['GAME_AUTH_URL'] = f"http://127.0.0.1:{stub_port}"
+
+    import fakeredis
+    from flask import Flask, jsonify, request
+    from werkzeug.serving import make_server
+    import app as game
+
+    server = fakeredis.FakeServer()
+    for name in list(game.redis_clients):
+        game.redis_clients[name] = fakeredis.FakeRedis(server=server)
+    if countdown is not None:
+        game.app.config['ROUND_COUNTDOWN'] = countdown
+    game.port = str(port)
+    with game.app.app_context():
+        game.db.create_all()
+
+    stub = Flask('stub_gateway')
+    game_url = f"http://127.0.0.1:{port}"
+
+    @stub.route('/gateway/start_bet_saga', methods=['POST'])
+    def start_bet_saga():
+        response = requests.post(f"{game_url}/game/v1/bet", json=request.json, timeout=10)
+        return response.content, response.status_code
+
+    @stub.route('/user/v1/balance/batch', methods=['POST'])
+    def balance_batch():
+        return jsonify({'status': 'Settled', 'applied': len((request.json or {}).get('entries', []))})
+
+    stub_server = make_server('127.0.0.1', stub_port, stub, threaded=True)
+    threading.Thread(target=stub_server.serve_forever, daemon=True).start()
+    threading.Thread(target=game.socketio.run, args=(game.app,), daemon=True,
+                     kwargs=dict(host='127.0.0.1', port=port, allow_unsafe_werkzeug=True, log_output=False)).start()
+
+    for _ in range(100):
+        try:
+            requests.get(f"{game_url}/game/v1/status", timeout=1)
+            break
+        except requests.exceptions.ConnectionError:
+            time.sleep(0.1)
+    return game
+
+
+def percentile(samples, p):
+    if not samples:
+        return float('nan')
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * p / 100))]
+
+
+def report(stats, args, elapsed):
+    print(f"clients {args.clients}, lobbies {args.lobbies}, {elapsed:.1f}s")
+    print(f"bets acked {len(stats.bet_ack)}, rejected {stats.rejected}, errors {stats.errors}")
+    for name, samples in (('bet ack', stats.bet_ack), ('cash-out to bet_result', stats.cashout),
+                          ('tick jitter', stats.tick_jitter)):
+        print(f"{name:<24} p50 {percentile(samples, 50) * 1000:8.1f} ms   p99 {percentile(samples, 99) * 1000:8.1f} ms"
+              f"   ({len(samples)} samples)")
+    print(f"{'messages received':<24} {stats.messages / elapsed:10.0f} /s")
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Socket.IO load generator for the crash game')
+    parser.add_argument('--url', default='http://localhost:5001', help='Game service to load')
+    parser.add_argument('--local', action='store_true', help='Run the game service in-process on SQLite + fakeredis')
+    parser.add_argument('--port', type=int, default=5100, help='Port for the in-process game service')
+    parser.add_argument('--stub-port', type=int, default=5101, help='Port for the in-process stub gateway/auth')
+    parser.add_argument('--countdown', type=float, help='Betting countdown of the in-process game service')
+    parser.add_argument('--clients', type=int, default=100, help='Simulated players')
+    parser.add_argument('--lobbies', type=int, default=10, help='Lobbies the players are spread over')
+    parser.add_argument('--duration', type=float, default=30, help='Seconds to run after every player connected')
+    parser.add_argument('--ramp', type=int, default=50, help='Players connecting at the same time')
+    parser.add_argument('--first-user-id', type=int, default=1, help='User id of the first player')
+    parser.add_argument('--withdraw-ratio', type=float, default=0.5, help='Share of bets cashed out by hand')
+    args = parser.parse_args()
+
+    if args.local:
+        start_local_stack(args.port, args.stub_port, args.countdown)
+        args.url = f"http://127.0.0.1:{args.port}"
+    from config import Config
+
+    tokens = [make_token(args.first_user_id + i, Config.JWT_SECRET_KEY, Config.JWT_ALGORITHM)
+              for i in range(args.clients)]
+    lobbies = create_lobbies(args.url, args.lobbies, tokens[0])
+    urls = {lobby_id: lobby_url(args.url, lobby_id) for lobby_id in lobbies}
+
+    stats = Stats()
+    players = [
+        Player(urls[lobbies[i % len(lobbies)]], args.first_user_id + i, lobbies[i % len(lobbies)], tokens[i], stats,
+               Config.TICK_INTERVAL, observer=i < len(lobbies), withdraw_ratio=args.withdraw_ratio)
+        for i in range(args.clients)
+    ]
+
+    with ThreadPoolExecutor(max_workers=args.ramp) as pool:
+        for player, error in zip(players, pool.map(connect_player, players)):
+            if error:
+                stats.error()
+                player.running = False
+    print(f"{sum(player.running for player in players)} players connected, running for {args.duration:.0f}s")
+
+    stats.reset()
+    start = time.perf_counter()
+    time.sleep(args.duration)
+    elapsed = time.perf_counter() - start
+    report(stats, args, elapsed)
+
+    if args.local:
+        # The in-process game loops never return, leave without waiting for them
+        sys.stdout.flush()
+        os._exit(0)
+    # A close waits up to a few seconds for the server's close frame, so close side by side
+    with ThreadPoolExecutor(max_workers=args.ramp) as pool:
+        list(pool.map(Player.close, [player for player in players if player.running]))
+
+
+def connect_player(player):
+    try:
+        player.connect()
+    except socketio.exceptions.ConnectionError as e:
+        return e
+    return None
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,127 @@
+from collections import OrderedDict
+import logging
+import os
+import threading
+import time
+
+import redis
+
+logger = logging.getLogger(__name__)
+
+# Round phases, in the order a lobby goes through them
+BETTING = 'betting'
+RUNNING = 'running'
+CRASHED = 'crashed'
+
+
+class LobbyCache:
+    """ Write-through cache of lobby metadata and round phase.
+
+    Reads are served from a small in-process LRU, then from a Redis hash on the node the
+    hash ring picks for the lobby, and only then from the database through `loader`.
+    Writes go to Redis and are announced on a pub/sub channel so every game replica drops
+    its local copy. Local entries also expire after `local_ttl` in case a message is lost.
+    """
+
+    def __init__(self, redis_ring, loader, channel='lobby_invalidate', max_size=10000, local_ttl=30,
+                 redis_ttl=86400):
+        self._redis_ring = redis_ring
+        self._loader = loader
+        self.channel = channel
+        self.max_size = max_size
+        self.local_ttl = local_ttl
+        self.redis_ttl = redis_ttl
+        self._instance_id = os.urandom(8).hex()
+        self._local = OrderedDict()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def key(lobby_id):
+        return f"lobby_state:{lobby_id}"
+
+    def _get_local(self, lobby_id):
+        with self._lock:
+            entry = self._local.get(lobby_id)
+            if entry is None:
+                return None
+            state, expires_at = entry
+            if expires_at <= time.monotonic():
+                del self._local[lobby_id]
+                return None
+            self._local.move_to_end(lobby_id)
+            return state
+
+    def _set_local(self, lobby_id, state):
+        with self._lock:
+            self._local[lobby_id] = (state, time.monotonic() + self.local_ttl)
+            self._local.move_to_end(lobby_id)
+            while len(self._local) > self.max_size:
+                self._local.popitem(last=False)
+
+    def invalidate_local(self, lobby_id=None):
+        with self._lock:
+            if lobby_id is None:
+                self._local.clear()
+            else:
+                self._local.pop(lobby_id, None)
+
+    def get(self, lobby_id):
+        """ Lobby state as {'port': int, 'phase': str, 'round_id': int}, or None if the lobby does not exist. """
+        state = self._get_local(lobby_id)
+        if state:
+            return state
+
+        key = self.key(lobby_id)
+        # While resharding the hash may still be on its previous owner, both are asked at once
+        batch = self._redis_ring.batch()
+        for node in self._redis_ring.owners(key):
+            batch.call_on(node, 'hgetall', key)
+        raw = next((found for found in batch.execute() if found), None)
+        if raw:
+            state = {'port': int(raw[b'port']) if b'port' in raw else None, 'phase': raw[b'phase'].decode('utf-8'),
+                     'round_id': int(raw[b'round_id']) if b'round_id' in raw else None}
+        else:
+            state = self._loader(lobby_id)
+            if state is None:
+                return None
+            self._write_redis(lobby_id, state, publish=False)
+
+        self._set_local(lobby_id, state)
+        return state
+
+    def set(self, lobby_id, **fields):
+        """ Update the lobby's state everywhere and tell the other replicas. """
+        state = {**(self.get(lobby_id) or {}), **fields}
+        self._write_redis(lobby_id, state, publish=True)
+        self._set_local(lobby_id, state)
+        return state
+
+    def set_phase(self, lobby_id, phase):
+        return self.set(lobby_id, phase=phase)
+
+    def _write_redis(self, lobby_id, state, publish):
+        key = self.key(lobby_id)
+        # The hash and the channel may live on different nodes, both are written in one round trip
+        batch = self._redis_ring.batch()
+        batch.call('hset', key, mapping={field: value for field, value in state.items() if value is not None})
+        batch.call('expire', key, self.redis_ttl)
+        if publish:
+            batch.call('publish', self.channel, f"{self._instance_id}:{lobby_id}")
+        batch.execute()
+
+    def listen(self):
+        """ Drop local entries that other replicas changed. Runs forever in a background task. """
+        while True:
+            try:
+                pubsub = self._redis_ring.client_for(self.channel).pubsub(ignore_subscribe_messages=True)
+                pubsub.subscribe(self.channel)
+                # Anything may have changed while we were not subscribed
+                self.invalidate_local()
+                for message in pubsub.listen():
+                    origin, lobby_id = message['data'].decode('utf-8').split(':', 1)
+                    if origin != self._instance_id:
+                        self.invalidate_local(int(lobby_id))
+            except redis.exceptions.RedisError as e:
+                logger.warning(f"Lobby invalidation listener lost Redis: {e}. Reconnecting...")
+                self.invalidate_local()
+                time.sleep(1)
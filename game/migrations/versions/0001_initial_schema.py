@@ -0,0 +1,43 @@
+"""Initial schema, as created by db.create_all()
+
+Revision ID: 0001
+Revises: 
+Create Date: 2024-11-02 12:00:00
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '0001'
+down_revision = None
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('lobby',
+    sa.Column('id', sa.Integer(), nullable=False),
+    sa.Column('initial_hash', sa.String(length=64), nullable=True),
+    sa.Column('current_hash', sa.String(length=64), nullable=True),
+    sa.Column('in_progress', sa.Boolean(), nullable=True),
+    sa.Column('port', sa.Integer(), nullable=False),
+    sa.PrimaryKeyConstraint('id')
+    )
+    op.create_table('bet',
+    sa.Column('id', sa.Integer(), nullable=False),
+    sa.Column('user_id', sa.Integer(), nullable=False),
+    sa.Column('lobby_id', sa.Integer(), nullable=False),
+    sa.Column('amount', sa.Float(), nullable=False),
+    sa.Column('coefficient', sa.Float(), nullable=False),
+    sa.Column('withdrawn', sa.Boolean(), nullable=True),
+    sa.Column('withdrawal_coefficient', sa.Float(), nullable=True),
+    sa.ForeignKeyConstraint(['lobby_id'], ['lobby.id'], ),
+    sa.PrimaryKeyConstraint('id')
+    )
+
+
+def downgrade():
+    op.drop_table('bet')
+    op.drop_table('lobby')
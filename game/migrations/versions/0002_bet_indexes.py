@@ -0,0 +1,28 @@
+"""Composite indexes for the bet access paths
+
+Revision ID: 0002
+Revises: 0001
+Create Date: 2024-11-02 12:30:00
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '0002'
+down_revision = '0001'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    with op.batch_alter_table('bet', schema=None) as batch_op:
+        batch_op.create_index('ix_bet_lobby_withdrawn_coefficient', ['lobby_id', 'withdrawn', 'coefficient'], unique=False)
+        batch_op.create_index('ix_bet_user_lobby_withdrawn', ['user_id', 'lobby_id', 'withdrawn'], unique=False)
+
+
+def downgrade():
+    with op.batch_alter_table('bet', schema=None) as batch_op:
+        batch_op.drop_index('ix_bet_user_lobby_withdrawn')
+        batch_op.drop_index('ix_bet_lobby_withdrawn_coefficient')
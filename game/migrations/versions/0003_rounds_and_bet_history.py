@@ -0,0 +1,105 @@
+"""Rounds, bets tied to a round and the bet_history archive
+
+Revision ID: 0003
+Revises: 0002
+Create Date: 2024-11-09 12:00:00
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '0003'
+down_revision = '0002'
+branch_labels = None
+depends_on = None
+
+BET_COLUMNS = ('id', 'user_id', 'lobby_id', 'round_id', 'amount', 'coefficient', 'withdrawn', 'withdrawal_coefficient')
+
+
+def upgrade():
+    op.create_table('round',
+    sa.Column('id', sa.Integer(), nullable=False),
+    sa.Column('lobby_id', sa.Integer(), nullable=False),
+    sa.Column('hash', sa.String(length=64), nullable=False),
+    sa.Column('crash_point', sa.Float(), nullable=True),
+    sa.Column('started_at', sa.DateTime(), nullable=True),
+    sa.Column('ended_at', sa.DateTime(), nullable=True),
+    sa.Column('archived', sa.Boolean(), nullable=True),
+    sa.ForeignKeyConstraint(['lobby_id'], ['lobby.id'], ),
+    sa.PrimaryKeyConstraint('id')
+    )
+    with op.batch_alter_table('round', schema=None) as batch_op:
+        batch_op.create_index('ix_round_archived_id', ['archived', 'id'], unique=False)
+        batch_op.create_index('ix_round_lobby_id', ['lobby_id', 'id'], unique=False)
+
+    op.create_table('bet_history',
+    sa.Column('id', sa.Integer(), autoincrement=False, nullable=False),
+    sa.Column('user_id', sa.Integer(), nullable=False),
+    sa.Column('lobby_id', sa.Integer(), nullable=False),
+    sa.Column('round_id', sa.Integer(), nullable=True),
+    sa.Column('amount', sa.Float(), nullable=False),
+    sa.Column('coefficient', sa.Float(), nullable=False),
+    sa.Column('withdrawn', sa.Boolean(), nullable=True),
+    sa.Column('withdrawal_coefficient', sa.Float(), nullable=True),
+    sa.PrimaryKeyConstraint('id')
+    )
+    with op.batch_alter_table('bet_history', schema=None) as batch_op:
+        batch_op.create_index('ix_bet_history_round_id', ['round_id', 'id'], unique=False)
+        batch_op.create_index('ix_bet_history_user_id', ['user_id', 'id'], unique=False)
+
+    with op.batch_alter_table('lobby', schema=None) as batch_op:
+        batch_op.add_column(sa.Column('current_round_id', sa.Integer(), nullable=True))
+
+    with op.batch_alter_table('bet', schema=None) as batch_op:
+        batch_op.add_column(sa.Column('round_id', sa.Integer(), nullable=True))
+        # The lobby_id foreign key must keep an index once the composite one is gone
+        batch_op.create_index('ix_bet_lobby_id', ['lobby_id'], unique=False)
+        batch_op.create_index('ix_bet_round_withdrawn_coefficient', ['round_id', 'withdrawn', 'coefficient'], unique=False)
+        batch_op.drop_index('ix_bet_lobby_withdrawn_coefficient')
+        batch_op.create_foreign_key('fk_bet_round_id', 'round', ['round_id'], ['id'])
+
+    # Every lobby gets an open round for its current hash, open bets move onto it
+    lobby = sa.table('lobby', sa.column('id'), sa.column('current_hash'), sa.column('current_round_id'))
+    game_round = sa.table('round', sa.column('id'), sa.column('lobby_id'), sa.column('hash'), sa.column('archived'))
+    bet = sa.table('bet', *(sa.column(name) for name in BET_COLUMNS))
+    bet_history = sa.table('bet_history', *(sa.column(name) for name in BET_COLUMNS))
+
+    op.execute(game_round.insert().from_select(
+        ['lobby_id', 'hash', 'archived'],
+        sa.select(lobby.c.id, lobby.c.current_hash, sa.false()),
+    ))
+    op.execute(lobby.update().values(current_round_id=(
+        sa.select(sa.func.max(game_round.c.id)).where(game_round.c.lobby_id == lobby.c.id).scalar_subquery()
+    )))
+    op.execute(bet.update().where(sa.or_(bet.c.withdrawn == sa.false(), bet.c.withdrawn.is_(None))).values(round_id=(
+        sa.select(lobby.c.current_round_id).where(lobby.c.id == bet.c.lobby_id).scalar_subquery()
+    )))
+
+    # Bets settled before rounds existed go straight to the archive
+    op.execute(bet_history.insert().from_select(
+        BET_COLUMNS, sa.select(*(bet.c[name] for name in BET_COLUMNS)).where(bet.c.round_id.is_(None))
+    ))
+    op.execute(bet.delete().where(bet.c.round_id.is_(None)))
+
+
+def downgrade():
+    bet = sa.table('bet', *(sa.column(name) for name in BET_COLUMNS))
+    bet_history = sa.table('bet_history', *(sa.column(name) for name in BET_COLUMNS))
+    op.execute(bet.insert().from_select(
+        BET_COLUMNS, sa.select(*(bet_history.c[name] for name in BET_COLUMNS))
+    ))
+
+    with op.batch_alter_table('bet', schema=None) as batch_op:
+        batch_op.drop_constraint('fk_bet_round_id', type_='foreignkey')
+        batch_op.create_index('ix_bet_lobby_withdrawn_coefficient', ['lobby_id', 'withdrawn', 'coefficient'], unique=False)
+        batch_op.drop_index('ix_bet_round_withdrawn_coefficient')
+        batch_op.drop_index('ix_bet_lobby_id')
+        batch_op.drop_column('round_id')
+
+    with op.batch_alter_table('lobby', schema=None) as batch_op:
+        batch_op.drop_column('current_round_id')
+
+    op.drop_table('bet_history')
+    op.drop_table('round')
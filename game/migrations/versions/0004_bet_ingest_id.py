@@ -0,0 +1,28 @@
+"""Ingest id on bets written from the bet queue
+
+Revision ID: 0004
+Revises: 0003
+Create Date: 2024-11-16 12:00:00
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '0004'
+down_revision = '0003'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    with op.batch_alter_table('bet', schema=None) as batch_op:
+        batch_op.add_column(sa.Column('ingest_id', sa.String(length=32), nullable=True))
+        batch_op.create_index('ix_bet_ingest_id', ['ingest_id'], unique=True)
+
+
+def downgrade():
+    with op.batch_alter_table('bet', schema=None) as batch_op:
+        batch_op.drop_index('ix_bet_ingest_id')
+        batch_op.drop_column('ingest_id')
@@ -0,0 +1,31 @@
+"""Play lobby hash chains backwards from a published commitment
+
+Revision ID: 0005
+Revises: 0004
+Create Date: 2024-11-20 12:00:00
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '0005'
+down_revision = '0004'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # Existing lobbies keep a NULL chain_length and start a new chain at their next round
+    with op.batch_alter_table('lobby', schema=None) as batch_op:
+        batch_op.add_column(sa.Column('chain_length', sa.Integer(), nullable=True))
+        batch_op.add_column(sa.Column('chain_commitment', sa.String(length=64), nullable=True))
+        batch_op.add_column(sa.Column('round_index', sa.Integer(), nullable=False, server_default='0'))
+
+
+def downgrade():
+    with op.batch_alter_table('lobby', schema=None) as batch_op:
+        batch_op.drop_column('round_index')
+        batch_op.drop_column('chain_commitment')
+        batch_op.drop_column('chain_length')
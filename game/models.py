@@ -4,19 +4,73 @@ db = SQLAlchemy()
 
 class Lobby(db.Model):
     id = db.Column(db.Integer, primary_key=True)
+    # Seed of the lobby's hash chain (see fairness.py), never sent to players
     initial_hash = db.Column(db.String(64))
+    # Hash of the round bets are placed on, secret until that round has been played
     current_hash = db.Column(db.String(64))
+    # Rounds in the chain, NULL for lobbies created before chains were played backwards
+    chain_length = db.Column(db.Integer, nullable=True)
+    # Hash the chain's first round hashes to, published before it is played
+    chain_commitment = db.Column(db.String(64), nullable=True)
+    # Rounds of the chain played before the current one
+    round_index = db.Column(db.Integer, nullable=False, default=0, server_default='0')
     in_progress = db.Column(db.Boolean, default=False)
     port = db.Column(db.Integer, nullable=False)
+    # Round that new bets are placed on
+    current_round_id = db.Column(db.Integer, nullable=True)
 
-    # Relationship to Bet
-    bets = db.relationship('Bet', backref='lobby', lazy=True)
+    # Relationship to Bet, as a query so it never loads the lobby's whole history
+    bets = db.relationship('Bet', backref='lobby', lazy='dynamic')
+
+class Round(db.Model):
+    __table_args__ = (
+        # A lobby's rounds, newest first (history API)
+        db.Index('ix_round_lobby_id', 'lobby_id', 'id'),
+        # Finished rounds waiting to be archived
+        db.Index('ix_round_archived_id', 'archived', 'id'),
+    )
+
+    id = db.Column(db.Integer, primary_key=True)
+    lobby_id = db.Column(db.Integer, db.ForeignKey('lobby.id'), nullable=False)
+    hash = db.Column(db.String(64), nullable=False)
+    crash_point = db.Column(db.Float, nullable=True)  # only set once the round has crashed
+    started_at = db.Column(db.DateTime, nullable=True)
+    ended_at = db.Column(db.DateTime, nullable=True)
+    archived = db.Column(db.Boolean, default=False)
 
 class Bet(db.Model):
+    __table_args__ = (
+        # Active bets of a round, in cash-out order (round start, settlement)
+        db.Index('ix_bet_round_withdrawn_coefficient', 'round_id', 'withdrawn', 'coefficient'),
+        # A player's active bet in a lobby (withdraw)
+        db.Index('ix_bet_user_lobby_withdrawn', 'user_id', 'lobby_id', 'withdrawn'),
+        # Bets written from the ingestion queue at most once
+        db.Index('ix_bet_ingest_id', 'ingest_id', unique=True),
+    )
+
     id = db.Column(db.Integer, primary_key=True)
     user_id = db.Column(db.Integer, nullable=False)
-    lobby_id = db.Column(db.Integer, db.ForeignKey('lobby.id'), nullable=False)
+    lobby_id = db.Column(db.Integer, db.ForeignKey('lobby.id'), nullable=False, index=True)
+    round_id = db.Column(db.Integer, db.ForeignKey('round.id', name='fk_bet_round_id'), nullable=True)
+    amount = db.Column(db.Float, nullable=False)
+    coefficient = db.Column(db.Float, nullable=False)
+    withdrawn = db.Column(db.Boolean, default=False)
+    withdrawal_coefficient = db.Column(db.Float, nullable=True)
+    ingest_id = db.Column(db.String(32), nullable=True)  # set on bets that came through the bet queue
+
+class BetHistory(db.Model):
+    """ Bets of finished rounds, moved out of `bet` so the active table stays small. """
+    __tablename__ = 'bet_history'
+    __table_args__ = (
+        db.Index('ix_bet_history_round_id', 'round_id', 'id'),
+        db.Index('ix_bet_history_user_id', 'user_id', 'id'),
+    )
+
+    id = db.Column(db.Integer, primary_key=True, autoincrement=False)
+    user_id = db.Column(db.Integer, nullable=False)
+    lobby_id = db.Column(db.Integer, nullable=False)
+    round_id = db.Column(db.Integer, nullable=True)
     amount = db.Column(db.Float, nullable=False)
     coefficient = db.Column(db.Float, nullable=False)
     withdrawn = db.Column(db.Boolean, default=False)
-    withdrawal_coefficient = db.Column(db.Float, nullable=True)
\ No newline at end of file
+    withdrawal_coefficient = db.Column(db.Float, nullable=True)
@@ -0,0 +1,89 @@
+""" Load-aware placement of lobbies on game service replicas.
+
+Every replica reports its load (active rounds, connected sockets, tick lag) to a registry
+hash on the Redis directory node. A new lobby goes to the least loaded live replica;
+replicas within `slack` of the best score are treated as equal and one of them is picked
+by consistent hashing on the lobby key, so bursts of new lobbies spread out instead of all
+landing on the replica that looked best a moment ago. Without fresh reports, placement
+falls back to consistent hashing over the registered replicas.
+"""
+import json
+import threading
+import time
+
+from hashring import HashRing
+
+REGISTRY_KEY = 'game:nodes'
+DRAINING_KEY = 'game:nodes:draining'
+
+
+class Placement:
+
+    def __init__(self, redis_ring, weights, node_ttl=10.0, slack=1.0):
+        self.redis_ring = redis_ring
+        self.weights = weights  # load field -> score per unit
+        self.node_ttl = node_ttl  # seconds without a report before a replica is considered gone
+        self.slack = slack
+        self.node_id = None
+        self.port = None
+        self.sockets = 0
+        self._lock = threading.Lock()
+
+    @property
+    def _directory(self):
+        return self.redis_ring.clients[self.redis_ring.directory]
+
+    def socket_opened(self):
+        with self._lock:
+            self.sockets += 1
+
+    def socket_closed(self):
+        with self._lock:
+            self.sockets = max(0, self.sockets - 1)
+
+    def report(self, **load):
+        """ Publish this replica's load. Returns True while the replica is being drained. """
+        report = {'port': self.port, 'sockets': self.sockets, **load, 'updated_at': time.time()}
+        pipe = self._directory.pipeline()
+        pipe.hset(REGISTRY_KEY, self.node_id, json.dumps(report))
+        pipe.sismember(DRAINING_KEY, self.node_id)
+        return bool(pipe.execute()[1])
+
+    def set_draining(self, node_id, draining):
+        if draining:
+            self._directory.sadd(DRAINING_KEY, node_id)
+        else:
+            self._directory.srem(DRAINING_KEY, node_id)
+
+    def nodes(self):
+        """ {node_id: report} for every registered replica, with `live` and `draining` flags. """
+        pipe = self._directory.pipeline()
+        pipe.hgetall(REGISTRY_KEY)
+        pipe.smembers(DRAINING_KEY)
+        raw, draining = pipe.execute()
+
+        now = time.time()
+        nodes = {}
+        for node_id, report in raw.items():
+            node_id = node_id.decode('utf-8')
+            report = json.loads(report)
+            report['live'] = now - report['updated_at'] <= self.node_ttl
+            report['draining'] = node_id.encode('utf-8') in draining
+            nodes[node_id] = report
+        return nodes
+
+    def score(self, report):
+        return sum(weight * report.get(field, 0) for field, weight in self.weights.items())
+
+    def choose(self, key, exclude=()):
+        """ Port of the replica that should host the lobby `key`, or None if none is known. """
+        candidates = {node_id: report for node_id, report in self.nodes().items()
+                      if not report['draining'] and node_id not in exclude}
+        live = {node_id: report for node_id, report in candidates.items() if report['live']}
+        if live:
+            scores = {node_id: self.score(report) for node_id, report in live.items()}
+            best = min(scores.values())
+            candidates = {node_id: live[node_id] for node_id, score in scores.items() if score <= best + self.slack}
+        if not candidates:
+            return None
+        return candidates[HashRing(sorted(candidates)).get_node(key)]['port']
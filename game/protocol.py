@@ -0,0 +1,52 @@
+""" Socket.IO wire protocol for lobby broadcasts.
+
+Clients pick a protocol when joining a lobby:
+
+- "stream" (default): a `coefficient_update` frame on every tick.
+- "curve": one `round_start` frame with the curve parameters, then only low-frequency
+  `coefficient_sync` frames and the `crash` frame. The client computes the multiplier
+  locally as `base + step * floor((now - started_at) / tick_interval)`.
+
+Curve frames can be sent as msgpack bytes instead of JSON when msgpack is installed.
+"""
+try:
+    import msgpack
+except ImportError:  # optional, curve clients fall back to JSON
+    msgpack = None
+
+STREAM = 'stream'
+CURVE = 'curve'
+PROTOCOLS = (STREAM, CURVE)
+
+JSON = 'json'
+MSGPACK = 'msgpack'
+
+
+def available_encodings():
+    return (JSON, MSGPACK) if msgpack else (JSON,)
+
+
+def lobby_room(lobby_id, protocol=STREAM, encoding=JSON):
+    if protocol == STREAM:
+        return f"lobby:{lobby_id}"
+    return f"lobby:{lobby_id}:{protocol}:{encoding}"
+
+
+def user_room(user_id):
+    return f"user:{user_id}"
+
+
+def encode_frame(payload, encoding):
+    if encoding == MSGPACK:
+        return msgpack.packb(payload)
+    return payload
+
+
+def curve_params(started_at, tick_interval, step=0.01, base=1.0):
+    """ Everything a curve client needs to draw the multiplier without per-tick frames. """
+    return {
+        'base': base,
+        'step': step,
+        'tick_interval': tick_interval,
+        'started_at': started_at,  # unix time (ms) of the first tick
+    }
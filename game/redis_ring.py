@@ -0,0 +1,156 @@
+from concurrent.futures import ThreadPoolExecutor
+
+import redis
+from hashring import HashRing
+
+import game_metrics
+
+
+def parse_nodes(spec):
+    """ "host:port,host:port" -> {host: {'host': host, 'port': port}}, in the given order. """
+    nodes = {}
+    for address in filter(None, (part.strip() for part in spec.split(','))):
+        host, _, port = address.partition(':')
+        nodes[host] = {'host': host, 'port': int(port or 6379)}
+    return nodes
+
+
+class CountingConnection(redis.Connection):
+    """ Counts round trips: a single command and a whole pipeline are one send each. """
+
+    def send_packed_command(self, command, check_health=True):
+        game_metrics.redis_round_trip()
+        super().send_packed_command(command, check_health)
+
+
+class RedisRing:
+    """ The Redis nodes behind the consistent hash ring, one bounded connection pool each.
+
+    `clients` maps node name to client and may be swapped out entry by entry (tests do).
+    Membership can change at runtime with `set_nodes`. While keys are being moved, the
+    previous ring is kept and `owners` lists both the new and the old owner of a key, so
+    readers can look in both places. Pinned keys (channels, ring metadata) always live on
+    the directory node, the first one configured. As with Redis Cluster hash tags, only the
+    part of a key inside {braces} picks its node, so keys sharing a tag live (and move) together.
+    """
+
+    def __init__(self, nodes, max_connections=50, pool_timeout=1.0, socket_timeout=None, pinned=(), max_workers=8):
+        self._pool_options = dict(max_connections=max_connections, timeout=pool_timeout, socket_timeout=socket_timeout)
+        self.clients = {}
+        self.directory = next(iter(nodes))
+        self._pinned = set(pinned)
+        self.nodes = {}
+        self.previous_nodes = None
+        self._rings = (None, None)
+        self.set_nodes(nodes)
+        # Nodes of a batch run side by side, each as a single pipeline
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='redis-batch')
+
+    def set_nodes(self, nodes, previous=None):
+        """ Switch to a new membership. Pass the old one as `previous` while keys are moving. """
+        for name, config in {**nodes, **(previous or {})}.items():
+            if name not in self.clients:
+                self.clients[name] = redis.Redis(connection_pool=redis.BlockingConnectionPool(
+                    connection_class=CountingConnection, **self._pool_options, **config))
+        # Readers see both rings or neither, never a half-built pair
+        self._rings = (HashRing(list(nodes)), HashRing(list(previous)) if previous else None)
+        self.nodes, self.previous_nodes = dict(nodes), (dict(previous) if previous else None)
+
+    @staticmethod
+    def _ring_key(key):
+        start = key.find('{')
+        if start != -1:
+            end = key.find('}', start + 1)
+            if end > start + 1:
+                return key[start + 1:end]
+        return key
+
+    @property
+    def migrating(self):
+        return self._rings[1] is not None
+
+    def node_for(self, key):
+        if key in self._pinned:
+            return self.directory
+        return self._rings[0].get_node(self._ring_key(key))
+
+    def previous_node_for(self, key):
+        """ The key's owner before the current membership change, or None if it did not move. """
+        ring, previous = self._rings
+        if previous is None or key in self._pinned:
+            return None
+        key = self._ring_key(key)
+        node = previous.get_node(key)
+        return node if node != ring.get_node(key) else None
+
+    def owners(self, key):
+        """ Where `key` may live: its owner, then its previous owner while resharding. """
+        previous = self.previous_node_for(key)
+        return [self.node_for(key), previous] if previous else [self.node_for(key)]
+
+    def client_for(self, key):
+        return self.clients[self.node_for(key)]
+
+    def batch(self, transaction=True):
+        return RedisBatch(self, transaction)
+
+    def execute_grouped(self, groups, transaction=True):
+        """ Run {node: [(command, args, kwargs), ...]} as one pipeline per node, nodes in parallel. """
+        source = game_metrics.current_source()
+
+        def run(node, commands):
+            # MULTI/EXEC keeps a node's share of the batch atomic, e.g. read-then-delete
+            pipe = self.clients[node].pipeline(transaction=transaction)
+            for command, args, kwargs in commands:
+                getattr(pipe, command)(*args, **kwargs)
+            with game_metrics.acting_for(source):
+                return pipe.execute()
+
+        if len(groups) == 1:
+            node, commands = next(iter(groups.items()))
+            return {node: run(node, commands)}
+
+        futures = {node: self._executor.submit(run, node, commands) for node, commands in groups.items()}
+        return {node: future.result() for node, future in futures.items()}
+
+
+class RedisBatch:
+    """ Commands for keys anywhere on the ring, sent as one round trip per node involved.
+
+        batch = redis_ring.batch()
+        batch.call('lrange', key_a, 0, -1)
+        batch.call('delete', key_a)
+        batch.call('publish', channel, message)
+        lrange_result, deleted, receivers = batch.execute()
+
+    The first argument after the command name is the key that picks the node. Results
+    come back in the order the commands were added. Batches of independent commands can
+    skip MULTI/EXEC with `transaction=False`.
+    """
+
+    def __init__(self, redis_ring, transaction=True):
+        self._redis_ring = redis_ring
+        self._transaction = transaction
+        self._groups = {}
+        self._order = []  # (node, index within that node's pipeline)
+
+    def __len__(self):
+        return len(self._order)
+
+    def call(self, command, key, *args, **kwargs):
+        return self.call_on(self._redis_ring.node_for(key), command, key, *args, **kwargs)
+
+    def call_on(self, node, command, *args, **kwargs):
+        """ Like `call`, but on a given node instead of the key's owner. """
+        commands = self._groups.setdefault(node, [])
+        self._order.append((node, len(commands)))
+        commands.append((command, args, kwargs))
+        return self
+
+    def execute(self):
+        if not self._order:
+            return []
+        groups, order = self._groups, self._order
+        self._groups, self._order = {}, []
+        results = self._redis_ring.execute_grouped(groups, self._transaction)
+        return [results[node][index] for node, index in order]
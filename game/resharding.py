@@ -0,0 +1,242 @@
+""" Online resharding of the Redis hash ring.
+
+Ring membership is a JSON document on the directory node:
+
+    {"version": 3, "nodes": {...}, "previous": {...} or null}
+
+Every game replica polls it and switches its `RedisRing` when the version changes. A
+document with `previous` set means keys are moving: writes go to the new owners, reads
+look at the new and then the old owner, and one replica (whoever holds the migrator
+lock) walks the previous nodes and moves only the keys whose owner changed. When a full
+pass is done it publishes the membership again without `previous`.
+
+Keys are moved with MIGRATE, which deletes a key from its old owner only once the new
+owner has it, and keeps stream entry ids and consumer groups. The node addresses in the
+membership must therefore be reachable from the Redis nodes themselves.
+"""
+import json
+import logging
+import os
+import time
+
+import redis
+
+logger = logging.getLogger(__name__)
+
+MEMBERSHIP_KEY = 'ring:membership'
+MIGRATOR_LOCK_KEY = 'ring:migrator'
+
+# The migrator lock is only extended or released by the replica that holds it
+EXTEND_LOCK = """
+if redis.call('get', KEYS[1]) == ARGV[1] then
+    return redis.call('expire', KEYS[1], ARGV[2])
+end
+return 0
+"""
+RELEASE_LOCK = """
+if redis.call('get', KEYS[1]) == ARGV[1] then
+    return redis.call('del', KEYS[1])
+end
+return 0
+"""
+# Drops a stream once its readers have emptied it. Returns 1 if the key is gone
+DROP_EMPTY_STREAM = """
+if redis.call('exists', KEYS[1]) == 0 then
+    return 1
+end
+if redis.call('type', KEYS[1])['ok'] == 'stream' and redis.call('xlen', KEYS[1]) == 0 then
+    redis.call('del', KEYS[1])
+    return 1
+end
+return 0
+"""
+
+
+class Resharder:
+
+    def __init__(self, redis_ring, poll_interval=2.0, batch_size=100, pause=0.05, lock_ttl=30, migrate_timeout=5000):
+        self.redis_ring = redis_ring
+        self.poll_interval = poll_interval
+        self.batch_size = batch_size
+        self.pause = pause  # seconds between batches, keeps the move from competing with game traffic
+        self.lock_ttl = lock_ttl
+        self.migrate_timeout = migrate_timeout  # milliseconds per MIGRATE
+        self.version = 0
+        self.moved = 0
+        self._instance_id = os.urandom(8).hex()
+        # Scripts are run on whichever client is passed in, the one registered with is never used
+        client = redis_ring.clients[redis_ring.directory]
+        self._extend_lock = client.register_script(EXTEND_LOCK)
+        self._release_lock = client.register_script(RELEASE_LOCK)
+        self._drop_empty_stream = client.register_script(DROP_EMPTY_STREAM)
+
+    @property
+    def _directory(self):
+        return self.redis_ring.clients[self.redis_ring.directory]
+
+    def membership(self):
+        return {'version': self.version, 'nodes': self.redis_ring.nodes, 'previous': self.redis_ring.previous_nodes}
+
+    def status(self):
+        return {**self.membership(), 'migrating': self.redis_ring.migrating, 'moved_keys': self.moved}
+
+    def refresh(self):
+        """ Load the shared membership, seeding it from our own config the first time. """
+        raw = self._directory.get(MEMBERSHIP_KEY)
+        if raw is None:
+            self._directory.set(MEMBERSHIP_KEY, json.dumps({**self.membership(), 'version': 1}), nx=True)
+            raw = self._directory.get(MEMBERSHIP_KEY)
+
+        membership = json.loads(raw)
+        if membership['version'] != self.version:
+            if self.redis_ring.directory not in membership['nodes']:
+                logger.error(f"Ring membership {membership['version']} drops the directory node, ignoring it")
+                return
+            self.redis_ring.set_nodes(membership['nodes'], membership['previous'])
+            self.version = membership['version']
+            logger.info(f"Redis ring is now version {self.version}: {list(membership['nodes'])}"
+                        f"{' (migrating)' if membership['previous'] else ''}")
+
+    def propose(self, nodes):
+        """ Start moving to `nodes`. Returns the new version, or None if a move is in progress. """
+        self.refresh()
+        if self.redis_ring.migrating:
+            return None
+        if self.redis_ring.directory not in nodes:
+            raise ValueError(f"{self.redis_ring.directory} holds the ring metadata and cannot be removed")
+
+        membership = {'version': self.version + 1, 'nodes': nodes, 'previous': self.redis_ring.nodes}
+        # Only one proposal can win for a given version
+        with self._directory.pipeline() as pipe:
+            try:
+                pipe.watch(MEMBERSHIP_KEY)
+                if json.loads(pipe.get(MEMBERSHIP_KEY))['version'] != self.version:
+                    return None
+                pipe.multi()
+                pipe.set(MEMBERSHIP_KEY, json.dumps(membership))
+                pipe.execute()
+            except redis.exceptions.WatchError:
+                return None
+        self.refresh()
+        return membership['version']
+
+    def watch(self):
+        """ Follow membership changes and take part in migrations. Runs forever in a background task. """
+        while True:
+            try:
+                self.refresh()
+                if self.redis_ring.migrating and self._hold_lock():
+                    # Let every replica switch to dual reads before moving anything
+                    time.sleep(2 * self.poll_interval)
+                    self.migrate()
+            except redis.exceptions.RedisError as e:
+                logger.warning(f"Redis ring watcher failed: {e}")
+            time.sleep(self.poll_interval)
+
+    def _hold_lock(self):
+        """ Take or extend the migrator lock. """
+        if self._directory.set(MIGRATOR_LOCK_KEY, self._instance_id, nx=True, ex=self.lock_ttl):
+            return True
+        return bool(self._extend_lock(keys=[MIGRATOR_LOCK_KEY], args=[self._instance_id, self.lock_ttl],
+                                      client=self._directory))
+
+    def _still_current(self, version):
+        """ Whether we still hold the lock and nobody has published a newer membership. """
+        if not self._hold_lock():
+            return False
+        self.refresh()
+        return self.version == version
+
+    def migrate(self):
+        """ Move every key whose owner changed, a throttled batch at a time, then finish the move. """
+        version = self.version
+        # Repeat until a full pass finds nothing left. Keys written to an old owner by a replica
+        # that had not switched yet are picked up by the next pass
+        moved = waiting = None
+        while moved != 0 or waiting:
+            moved = waiting = 0
+            for node in list(self.redis_ring.previous_nodes):
+                cursor = None
+                while cursor != 0:
+                    if not self._still_current(version):
+                        return False
+                    cursor, keys = self.redis_ring.clients[node].scan(cursor or 0, count=self.batch_size)
+                    batch_moved, batch_waiting = self._move_keys(node, keys)
+                    moved += batch_moved
+                    waiting += batch_waiting
+                    time.sleep(self.pause)
+            self.moved += moved
+            if waiting:
+                logger.info(f"Redis ring migration: {waiting} keys still waiting to be moved")
+
+        # Publish the finished membership only if no other proposal got in since the last check
+        membership = {'version': version + 1, 'nodes': self.redis_ring.nodes, 'previous': None}
+        with self._directory.pipeline() as pipe:
+            try:
+                pipe.watch(MEMBERSHIP_KEY)
+                if json.loads(pipe.get(MEMBERSHIP_KEY))['version'] != version:
+                    return False
+                pipe.multi()
+                pipe.set(MEMBERSHIP_KEY, json.dumps(membership))
+                pipe.execute()
+            except redis.exceptions.WatchError:
+                return False
+        self._release_lock(keys=[MIGRATOR_LOCK_KEY], args=[self._instance_id], client=self._directory)
+        self.refresh()
+        logger.info(f"Redis ring migration finished, {self.moved} keys moved")
+        return True
+
+    def _move_keys(self, node, keys):
+        """ MIGRATE the keys of `node` that now belong elsewhere. Returns (moved, still waiting). """
+        moving = {}
+        for key in keys:
+            owner = self.redis_ring.node_for(key.decode('utf-8'))
+            if owner != node:
+                moving.setdefault(owner, []).append(key)
+
+        source = self.redis_ring.clients[node]
+        moved = waiting = 0
+        for owner, owner_keys in moving.items():
+            address = self.redis_ring.nodes[owner]
+            try:
+                # Moves every key that does not exist at the new owner yet, even if some do
+                source.migrate(address['host'], address['port'], owner_keys, 0, self.migrate_timeout)
+            except redis.exceptions.ResponseError as e:
+                if 'BUSYKEY' not in str(e):
+                    logger.warning(f"Could not move keys from {node} to {owner}: {e}")
+                    waiting += len(owner_keys)
+                    continue
+
+            pipe = source.pipeline(transaction=False)
+            for key in owner_keys:
+                pipe.exists(key)
+            busy = [key for key, left in zip(owner_keys, pipe.execute()) if left]
+            moved += len(owner_keys) - len(busy)
+
+            # Already written at the new owner
+            target = self.redis_ring.clients[owner]
+            for key in busy:
+                if self._merge_busy(source, target, key):
+                    moved += 1
+                else:
+                    waiting += 1
+        return moved, waiting
+
+    def _merge_busy(self, source, target, key):
+        """ Settle a key that exists at both owners. Returns False if it has to wait for a later pass. """
+        key_type = source.type(key)
+        if key_type == b'list':
+            # Queues keep the entries from both sides. Taking them is atomic, so nothing pushed to
+            # the old copy in the meantime is lost: it is left for the next pass
+            with source.pipeline() as pipe:
+                entries, _ = pipe.lrange(key, 0, -1).delete(key).execute()
+            if entries:
+                target.rpush(key, *entries)
+            return True
+        if key_type == b'stream':
+            # Entry ids and consumer groups cannot be merged into another stream. Stream readers
+            # consume both owners while resharding, so the old copy is dropped once they emptied it
+            return bool(self._drop_empty_stream(keys=[key], client=source))
+        # Anything else keeps the new owner's copy
+        source.delete(key)
+        return True
@@ -0,0 +1,118 @@
+from bisect import bisect_right
+from sqlalchemy import case, func, select, update
+from models import db, Bet
+
+
+class BetBook:
+    """ In-memory book of a round's open bets, sorted by auto-cashout coefficient.
+
+    Entries are (bet_id, user_id, amount, coefficient) tuples. Crossing a coefficient
+    bisects to the last reached target and closes that slice, so a tick only pays for
+    the bets that actually settle.
+    """
+
+    def __init__(self, bets):
+        self._entries = sorted(bets, key=lambda bet: bet[3])
+        self._targets = [bet[3] for bet in self._entries]
+        self._cursor = 0
+        self._closed = set()
+        self._ids = {bet[0] for bet in self._entries}
+        self._by_user = {}
+        for bet in self._entries:
+            self._by_user.setdefault(bet[1], []).append(bet)
+
+    @classmethod
+    def load(cls, round_id):
+        return cls(db.session.execute(
+            select(Bet.id, Bet.user_id, Bet.amount, Bet.coefficient)
+            .where(Bet.round_id == round_id, Bet.withdrawn == False)
+        ).all())
+
+    def __len__(self):
+        return len(self._entries) - len(self._closed)
+
+    def cross(self, coefficient):
+        """ Close and return every open bet whose target is at or below `coefficient`. """
+        end = bisect_right(self._targets, coefficient)
+        if end <= self._cursor:
+            return []
+
+        crossed = [bet for bet in self._entries[self._cursor:end] if bet[0] not in self._closed]
+        self._cursor = end
+        self._closed.update(bet[0] for bet in crossed)
+        return crossed
+
+    def withdraw(self, user_id):
+        """ Close and return the user's open bets (manual cash-out). """
+        bets = [bet for bet in self._by_user.pop(user_id, ()) if bet[0] not in self._closed]
+        self._closed.update(bet[0] for bet in bets)
+        return bets
+
+    def late_bets(self, round_id, user_ids):
+        """ Open bets of `user_ids` in the round that reached the table after the book was loaded. """
+        rows = db.session.execute(
+            select(Bet.id, Bet.user_id, Bet.amount, Bet.coefficient)
+            .where(Bet.round_id == round_id, Bet.withdrawn == False, Bet.user_id.in_(user_ids))
+        ).all()
+        return [tuple(row) for row in rows if row[0] not in self._ids]
+
+
+class SettlementBuffer:
+    """ Collects the bets cashed out during a tick and writes them back in one UPDATE. """
+
+    def __init__(self):
+        self._pending = {}  # bet id -> withdrawal coefficient
+
+    def __len__(self):
+        return len(self._pending)
+
+    def add(self, bet_id, coefficient):
+        self._pending[bet_id] = coefficient
+
+    def flush(self):
+        """ Persist every buffered withdrawal with a single statement and commit. """
+        if not self._pending:
+            return 0
+
+        pending, self._pending = self._pending, {}
+        coefficients = set(pending.values())
+        if len(coefficients) == 1:
+            withdrawal_coefficient = coefficients.pop()
+        else:
+            withdrawal_coefficient = case(pending, value=Bet.id)
+
+        db.session.execute(
+            update(Bet)
+            .where(Bet.id.in_(pending.keys()), Bet.withdrawn == False)
+            .values(withdrawn=True, withdrawal_coefficient=withdrawal_coefficient)
+            .execution_options(synchronize_session=False)
+        )
+        db.session.commit()
+        return len(pending)
+
+
+def settle_round(round_id, crash_point):
+    """ Resolve every bet still open when the round crashed, set-based.
+
+    Bets in the round's BetBook are settled as the coefficient rises, so this only pays
+    out bets that reached the table after the book was loaded. Bets whose auto-cashout
+    coefficient was reached pay out at that coefficient, the rest lose. Returns the payout
+    per user; the caller commits.
+    """
+    winnings = db.session.execute(
+        select(Bet.user_id, func.sum(Bet.amount * Bet.coefficient))
+        .where(Bet.round_id == round_id, Bet.withdrawn == False, Bet.coefficient <= crash_point)
+        .group_by(Bet.user_id)
+        .with_for_update()
+    ).all()
+
+    db.session.execute(
+        update(Bet)
+        .where(Bet.round_id == round_id, Bet.withdrawn == False)
+        .values(
+            withdrawn=True,
+            withdrawal_coefficient=case((Bet.coefficient <= crash_point, Bet.coefficient), else_=None),
+        )
+        .execution_options(synchronize_session=False)
+    )
+    return {user_id: payout for user_id, payout in winnings}
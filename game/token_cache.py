@@ -0,0 +1,56 @@
+from collections import OrderedDict
+import threading
+import time
+
+import jwt
+
+
+class TokenCache:
+    """ Bounded LRU cache of validated identities keyed by raw JWT.
+
+    Entries expire at the token's own `exp` claim (capped by `ttl`), so a cached
+    identity is never served for longer than the token itself is valid.
+    """
+
+    def __init__(self, max_size=10000, ttl=300):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, token):
+        with self._lock:
+            entry = self._entries.get(token)
+            if entry is None:
+                return None
+            user_info, expires_at = entry
+            if expires_at <= time.time():
+                del self._entries[token]
+                return None
+            self._entries.move_to_end(token)
+            return user_info
+
+    def set(self, token, user_info, exp=None):
+        expires_at = time.time() + self.ttl
+        if exp is not None:
+            expires_at = min(expires_at, exp)
+        if expires_at <= time.time():
+            return
+
+        with self._lock:
+            self._entries[token] = (user_info, expires_at)
+            self._entries.move_to_end(token)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+def decode_token(token, key, algorithms):
+    """ Verify a token in-process. Returns the claims, or None if the token is invalid or expired. """
+    try:
+        return jwt.decode(token, key, algorithms=algorithms, options={"require": ["exp", "sub"]})
+    except jwt.InvalidTokenError:
+        return None
@@ -13,6 +13,7 @@ import java.util.ArrayList;
 import java.util.HashMap;
 import java.util.List;
 import java.util.Map;
+import java.util.UUID;
 
 @RestController
 @RequestMapping("/gateway")
@@ -26,6 +27,9 @@ public class GatewayController {
 
     private final RestTemplate restTemplate;
 
+    // Binlog position returned by auth service writes, passed back on reads for read-your-writes
+    private static final String CONSISTENCY_HEADER = "X-Consistency-Token";
+
     public GatewayController() {
         this.restTemplate = this.createRestTemplate();
     }
@@ -152,10 +156,12 @@ public class GatewayController {
     }
 
     @PostMapping("/start_bet_saga")
-    public ResponseEntity<String> start_bet_saga(@RequestHeader("Authorization") String token, @RequestBody Map<String, Object> request) {
+    public ResponseEntity<String> start_bet_saga(@RequestHeader("Authorization") String token,
+                                                 @RequestHeader(value = CONSISTENCY_HEADER, required = false) String consistencyToken,
+                                                 @RequestBody Map<String, Object> request) {
         double amount = Double.parseDouble(request.get("amount").toString());
 
-        ResponseEntity<String> response0 = getBalance(token);
+        ResponseEntity<String> response0 = getBalance(token, consistencyToken);
         if (!response0.getStatusCode().is2xxSuccessful()) {
             return ResponseEntity.status(response0.getStatusCode()).body("Failed to retrieve balance: " + response0.getBody());
         }
@@ -176,7 +182,7 @@ public class GatewayController {
         // Step 1: Update balance
         Map<String, Object> revertRequest = new HashMap<>(request);
         revertRequest.put("amount", -amount);
-        ResponseEntity<String> response1 = updateBalance(token, revertRequest);
+        ResponseEntity<String> response1 = updateBalance(token, null, revertRequest);
         if (!response1.getStatusCode().is2xxSuccessful()) {
             // Return early if updating the balance fails
             return ResponseEntity.status(response1.getStatusCode()).body("Failed to update balance: " + response1.getBody());
@@ -186,7 +192,7 @@ public class GatewayController {
         ResponseEntity<String> response2 = place_bet(token, request);
         if (!response2.getStatusCode().is2xxSuccessful()) {
             // Revert the balance if placing the bet fails
-            ResponseEntity<String> rollbackResponse = updateBalance(token, request);
+            ResponseEntity<String> rollbackResponse = updateBalance(token, null, request);
             if (!rollbackResponse.getStatusCode().is2xxSuccessful()) {
                 return ResponseEntity.status(rollbackResponse.getStatusCode())
                         .body("Failed to revert balance after bet failure: " + rollbackResponse.getBody());
@@ -194,8 +200,13 @@ public class GatewayController {
             return ResponseEntity.status(response2.getStatusCode()).body("Failed to place bet: " + response2.getBody());
         }
 
-        // Success response
-        return ResponseEntity.ok("Bet placed successfully");
+        // Success response, with the token of the balance update so the client's next reads see it
+        ResponseEntity.BodyBuilder ok = ResponseEntity.ok();
+        String balanceToken = response1.getHeaders().getFirst(CONSISTENCY_HEADER);
+        if (balanceToken != null) {
+            ok.header(CONSISTENCY_HEADER, balanceToken);
+        }
+        return ok.body("Bet placed successfully");
     }
 
     @PostMapping("/game/v1/bet")
@@ -276,7 +287,8 @@ public class GatewayController {
     }
 
     @GetMapping("/user/v1/balance")
-    public ResponseEntity<String> getBalance(@RequestHeader("Authorization") String token) {
+    public ResponseEntity<String> getBalance(@RequestHeader("Authorization") String token,
+                                             @RequestHeader(value = CONSISTENCY_HEADER, required = false) String consistencyToken) {
         List<String> urls = new ArrayList<>(services.get("auth_service"));
         String url = getNextServiceUrl("auth_service");
         urls.remove(url);
@@ -284,11 +296,12 @@ public class GatewayController {
         url = url + "/user/v1/balance";
         urls.replaceAll(s -> s + "/user/v1/balance");
 
-        return getWithAuth(url, urls, token);
+        return getWithAuth(url, urls, token, consistencyToken);
     }
 
     @GetMapping("/user/v1/auth/validate")
-    public ResponseEntity<String> validate(@RequestHeader("Authorization") String token) {
+    public ResponseEntity<String> validate(@RequestHeader("Authorization") String token,
+                                           @RequestHeader(value = CONSISTENCY_HEADER, required = false) String consistencyToken) {
         List<String> urls = new ArrayList<>(services.get("auth_service"));
         String url = getNextServiceUrl("auth_service");
         urls.remove(url);
@@ -296,7 +309,7 @@ public class GatewayController {
         url = url + "/user/v1/auth/validate";
         urls.replaceAll(s -> s + "/user/v1/auth/validate");
 
-        return getWithAuth(url, urls, token);
+        return getWithAuth(url, urls, token, consistencyToken);
     }
 
     @PostMapping("/user/v1/balance")
@@ -311,7 +324,9 @@ public class GatewayController {
     }
 
     @PutMapping("/user/v1/balance")
-    public ResponseEntity<String> updateBalance(@RequestHeader("Authorization") String token, @RequestBody Map<String, Object> request) {
+    public ResponseEntity<String> updateBalance(@RequestHeader("Authorization") String token,
+                                                @RequestHeader(value = "Idempotency-Key", required = false) String idempotencyKey,
+                                                @RequestBody Map<String, Object> request) {
         List<String> urls = new ArrayList<>(services.get("auth_service"));
         String url = getNextServiceUrl("auth_service");
         urls.remove(url);
@@ -319,7 +334,11 @@ public class GatewayController {
         url = url + "/user/v1/balance";
         urls.replaceAll(s -> s + "/user/v1/balance");
 
-        return putWithAuth(url, urls, token, request);
+        // One key for every retry below, so the auth service applies the change once
+        if (idempotencyKey == null) {
+            idempotencyKey = UUID.randomUUID().toString();
+        }
+        return putWithAuth(url, urls, token, request, idempotencyKey);
     }
 
     private ResponseEntity<String> postWithAuth(String url, List<String> other_urls, String token, Map<String, Object> request) {
@@ -352,9 +371,10 @@ public class GatewayController {
         return ResponseEntity.status(HttpStatus.INTERNAL_SERVER_ERROR).body("All services are down:");
     }
 
-    private ResponseEntity<String> putWithAuth(String url, List<String> other_urls, String token, Map<String, Object> request) {
+    private ResponseEntity<String> putWithAuth(String url, List<String> other_urls, String token, Map<String, Object> request, String idempotencyKey) {
         HttpHeaders headers = new HttpHeaders();
         headers.add("Authorization", token); // Set the Authorization header with Bearer prefix
+        headers.add("Idempotency-Key", idempotencyKey);
         headers.setContentType(MediaType.APPLICATION_JSON); // Set the content type to JSON
 
         List<String> allUrls = new ArrayList<>();
@@ -382,9 +402,12 @@ public class GatewayController {
         return ResponseEntity.status(HttpStatus.INTERNAL_SERVER_ERROR).body("All services are down:");
     }
 
-    private ResponseEntity<String> getWithAuth(String url, List<String> other_urls, String token) {
+    private ResponseEntity<String> getWithAuth(String url, List<String> other_urls, String token, String consistencyToken) {
         HttpHeaders headers = new HttpHeaders();
         headers.add("Authorization", token); // Set the Authorization header with Bearer prefix
+        if (consistencyToken != null) {
+            headers.add(CONSISTENCY_HEADER, consistencyToken); // Lets the auth service read from a replica that has the client's writes
+        }
 
         List<String> allUrls = new ArrayList<>();
         allUrls.add(url);